@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.server import LIST_PATH, StandInServer, synthetic_files
+from model.training.collection import DataCollector
+from model.training.preprocess import DATASET_COLUMNS, PreprocessData
+from model.training.train import LateralModel, LateralRecommender
+from utils.dataset_registry import DatasetRegistry
+
+
+def _latency_stats(seconds):
+    milliseconds = np.asarray(seconds) * 1000
+    return {
+        "count": int(milliseconds.size),
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+        "mean_ms": float(milliseconds.mean()),
+    }
+
+
+def _timed(func, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def bench_collection(work_path, server, paths, args):
+    results = {}
+    raw_path = work_path / "raw"
+    raw_path.mkdir()
+
+    collector = DataCollector(
+        raw_path,
+        pool_size=args.workers,
+        max_retries=args.max_retries,
+        backoff_factor=0.01,
+        projected_columns=DATASET_COLUMNS if args.projected else None,
+    )
+    base_url = server.base_url
+    urls = [base_url + path for path in paths]
+
+    _, seconds = _timed(collector.download_data_list, base_url + LIST_PATH)
+    results["download_data_list"] = {"seconds": seconds}
+
+    # Cold probes of every file, concurrent, then served from the cache
+    _, seconds = _timed(collector.get_remote_metadata, urls, args.workers)
+    results["get_remote_metadata"] = {
+        "seconds": seconds,
+        "urls_per_sec": len(urls) / seconds,
+    }
+
+    check_times = [_timed(collector.check_url, url, base_url)[1] for url in urls]
+    results["check_url_cached"] = _latency_stats(check_times)
+
+    # Nothing is ever fresh with a ttl of 0, every check_url probes
+    probe_path = work_path / "probe"
+    probe_path.mkdir()
+    probe_collector = DataCollector(
+        probe_path, max_retries=args.max_retries, metadata_ttl=0
+    )
+    check_times = [_timed(probe_collector.check_url, url, base_url)[1] for url in urls]
+    results["check_url_probe"] = _latency_stats(check_times)
+
+    # Expired entries now, each probe revalidates with the stored ETag
+    not_modified = server.not_modified
+    check_times = [_timed(probe_collector.check_url, url, base_url)[1] for url in urls]
+    results["check_url_revalidate"] = _latency_stats(check_times)
+    results["check_url_revalidate"]["not_modified"] = server.not_modified - not_modified
+    probe_collector.close()
+
+    dataset_dir_name = collector.create_dataset()
+    bytes_sent = server.bytes_sent
+    batch, seconds = _timed(
+        collector.download_dataset_batch,
+        base_url,
+        paths,
+        dataset_dir_name,
+        args.workers,
+    )
+    downloaded_bytes = sum(len(server.files[path]) for path in batch["downloaded"])
+    results["download_dataset_batch"] = {
+        "seconds": seconds,
+        "files": len(batch["downloaded"]),
+        "failed": len(batch["failed"]),
+        "files_per_sec": len(batch["downloaded"]) / seconds,
+        "mb_per_sec": downloaded_bytes / seconds / 1e6,
+        "final_concurrency": batch["scheduler"]["concurrency"],
+        "network_bytes": server.bytes_sent - bytes_sent,
+        "disk_bytes": sum(
+            f.stat().st_size
+            for f in (raw_path / "datasets" / dataset_dir_name).glob("*.parquet")
+        ),
+    }
+
+    _, seconds = _timed(collector.update_db)
+    results["update_db"] = {"seconds": seconds}
+
+    collector.close()
+    return results, dataset_dir_name
+
+
+def bench_preprocess(work_path, dataset_dir_name, args):
+    preprocessed_path = work_path / "preprocessed"
+    preprocessed_path.mkdir()
+    preprocess_data = PreprocessData(
+        preprocessed_path, work_path / "raw" / "datasets", min_domains=args.min_domains
+    )
+
+    result, seconds = _timed(preprocess_data.preprocess, dataset_dir_name)
+    rows = len(result["processed"]) * args.rows
+
+    # Nothing changed, only the manifest is checked
+    _, noop_seconds = _timed(preprocess_data.preprocess, dataset_dir_name)
+
+    return preprocess_data, {
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_sec": rows / seconds,
+        "unchanged_seconds": noop_seconds,
+    }
+
+
+def bench_recommender(preprocess_data, dataset_dir_name, args):
+    results = {}
+    dataset, vocabulary, _ = preprocess_data.load(dataset_dir_name)
+
+    lateral_model, seconds = _timed(LateralModel.build, dataset, vocabulary)
+    results["build"] = {"seconds": seconds, "dirs": len(vocabulary)}
+
+    # Queries of 1 to 5 known directories
+    rng = np.random.default_rng(args.seed)
+    tokens = vocabulary.idx_to_token[1:]
+    queries = [
+        list(rng.choice(tokens, min(len(tokens), rng.integers(1, 6))))
+        for _ in range(args.queries)
+    ]
+
+    recommender = LateralRecommender(lateral_model)
+    query_times = [
+        _timed(recommender.recommend_batch, [query], args.top_k)[1] for query in queries
+    ]
+    results["query"] = _latency_stats(query_times)
+
+    cached_times = [
+        _timed(recommender.recommend, query, args.top_k)[1] for query in queries * 2
+    ]
+    results["query_cached"] = _latency_stats(cached_times[len(queries) :])
+
+    _, seconds = _timed(recommender.recommend_batch, queries, args.top_k)
+    results["batch"] = {"seconds": seconds, "queries_per_sec": len(queries) / seconds}
+
+    return results
+
+
+def bench_registry(work_path, args):
+    results = {}
+    registry = DatasetRegistry(work_path / "registry.db")
+    names = [f"dataset-{i}" for i in range(args.datasets)]
+
+    def add_all():
+        with registry.transaction():
+            for i, name in enumerate(names):
+                registry.add(f"{i:032x}", name, f"list-{i % 100}")
+
+    _, seconds = _timed(add_all)
+    results["add_batch"] = {"seconds": seconds, "datasets": len(names)}
+
+    # Single writes, one transaction each like the interactive menu
+    add_times = [
+        _timed(registry.add, f"single-{i}", f"single-{i}", "list-0")[1]
+        for i in range(100)
+    ]
+    results["add"] = _latency_stats(add_times)
+
+    lookup_times = [_timed(registry.name_to_id, name)[1] for name in names]
+    results["name_to_id"] = _latency_stats(lookup_times)
+
+    _, seconds = _timed(registry.list_usage)
+    results["list_usage"] = {"seconds": seconds}
+
+    registry.close()
+    return results
+
+
+def run(args):
+    files, paths = synthetic_files(args.files, args.rows, args.seed)
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            name: str(value) if isinstance(value, Path) else value
+            for name, value in vars(args).items()
+        },
+        "results": {},
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_path = Path(work_dir)
+        server = StandInServer(
+            files,
+            latency=args.latency_ms / 1000,
+            bandwidth=args.bandwidth,
+            failure_rate=args.failure_rate,
+            seed=args.seed,
+            max_in_flight=args.server_max_in_flight,
+        )
+
+        with server:
+            collection, dataset_dir_name = bench_collection(
+                work_path, server, paths, args
+            )
+        collection["server_requests"] = server.requests
+        collection["server_throttled"] = server.throttled
+        report["results"]["collection"] = collection
+
+        preprocess_data, report["results"]["preprocess"] = bench_preprocess(
+            work_path, dataset_dir_name, args
+        )
+        report["results"]["recommender"] = bench_recommender(
+            preprocess_data, dataset_dir_name, args
+        )
+        report["results"]["registry"] = bench_registry(work_path, args)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks against a local Common Crawl stand-in server"
+    )
+    parser.add_argument("--output", type=Path, help="JSON results file")
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=20000, help="Rows per file")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument(
+        "--bandwidth", type=int, default=0, help="Bytes/sec per connection, 0 is off"
+    )
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--server-max-in-flight",
+        type=int,
+        default=0,
+        help="Downloads the server sends at once before answering 503, 0 is off",
+    )
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument(
+        "--projected",
+        action="store_true",
+        help="Fetch only the columns used by preprocessing",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--min-domains", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=100)
+    parser.add_argument(
+        "--datasets", type=int, default=5000, help="Datasets in the registry"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = run(args)
+    report_json = json.dumps(report, indent=4)
+
+    if args.output is None:
+        print(report_json)
+    else:
+        args.output.write_text(report_json + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
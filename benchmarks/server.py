@@ -0,0 +1,248 @@
+import gzip
+import hashlib
+import io
+import random
+import re
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+CRAWL = "CC-MAIN-2000-01"
+LIST_PATH = f"crawl-data/{CRAWL}/cc-index-table.paths.gz"
+
+
+def synthetic_index_table(rows, seed=0, n_domains=2000, n_dirs=5000):
+    """Rows shaped like the cc-index table columns used by preprocess.py.
+
+    Domains and directories are Zipf distributed so frequent tokens and
+    long tails look like the real crawl. Filler columns stand in for the
+    rest of the table, which projected downloads skip.
+    """
+    rng = np.random.default_rng(seed)
+
+    def zipf(n, size):
+        return np.minimum(rng.zipf(1.3, size), n) - 1
+
+    domains = np.char.add("site", zipf(n_domains, rows).astype(str))
+    domains = np.char.add(domains, ".com")
+
+    depths = rng.integers(0, 5, rows)
+    dirs = np.char.add("dir", zipf(n_dirs, int(depths.sum())).astype(str))
+    splits = np.split(dirs, np.cumsum(depths)[:-1])
+    url_paths = [
+        "/" + "/".join(parts) + ("/" if parts.size else "") for parts in splits
+    ]
+
+    urls = np.char.add(np.char.add("https://", domains), url_paths)
+    return pd.DataFrame(
+        {
+            "url_surtkey": np.char.add("com,", domains).astype(object),
+            "url": urls.astype(object),
+            "url_host_registered_domain": domains.astype(object),
+            "url_path": url_paths,
+            "fetch_time": pd.Timestamp("2000-01-01")
+            + pd.to_timedelta(rng.integers(0, 86400 * 30, rows), unit="s"),
+            "fetch_status": rng.choice([200, 301, 404], rows, p=[0.8, 0.1, 0.1]),
+            "content_mime_type": rng.choice(["text/html", "application/pdf"], rows),
+            "content_digest": [
+                f"{digest:032X}" for digest in rng.integers(0, 2**63, rows)
+            ],
+            "warc_filename": np.char.add(
+                f"crawl-data/{CRAWL}/segments/", rng.integers(0, 100, rows).astype(str)
+            ).astype(object),
+            "warc_record_offset": rng.integers(0, 2**30, rows),
+            "warc_record_length": rng.integers(500, 50000, rows),
+        }
+    )
+
+
+def synthetic_files(n_files, rows_per_file, seed=0):
+    # Parquet files of one crawl plus the gzip list pointing to them
+    files = {}
+    paths = []
+    for i in range(n_files):
+        path = (
+            f"cc-index/table/cc-main/warc/crawl={CRAWL}/subset=warc/"
+            f"part-{i:05d}.c000.gz.parquet"
+        )
+        buffer = io.BytesIO()
+        # Several row groups per file, like the real index tables
+        synthetic_index_table(rows_per_file, seed + i).to_parquet(
+            buffer, row_group_size=max(1, rows_per_file // 4)
+        )
+        files[path] = buffer.getvalue()
+        paths.append(path)
+
+    files[LIST_PATH] = gzip.compress(("\n".join(paths) + "\n").encode())
+    return files, paths
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _fail(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.lock:
+            server.requests += 1
+            failed = server.rng.random() < server.failure_rate
+            throttled = bool(server.max_in_flight) and (
+                server.in_flight >= server.max_in_flight
+            )
+            if throttled:
+                server.throttled += 1
+
+        if failed or throttled:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.send_header("Retry-After", str(server.retry_after))
+            self.end_headers()
+            return True
+
+        return False
+
+    def _file(self):
+        body = self.server.files.get(self.path.lstrip("/"))
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        return body
+
+    def _send_headers(self, status, body, length):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", f'"{hashlib.md5(body).hexdigest()}"')
+        self.send_header("Last-Modified", formatdate(self.server.started, usegmt=True))
+        self.send_header("Accept-Ranges", "bytes")
+
+    def do_HEAD(self):
+        if self._fail() or (body := self._file()) is None:
+            return
+
+        # Revalidation of a cached entry, the files never change
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            with self.server.lock:
+                self.server.not_modified += 1
+            self._send_headers(304, body, 0)
+            self.end_headers()
+            return
+
+        self._send_headers(200, body, len(body))
+        self.end_headers()
+
+    def do_GET(self):
+        if self._fail() or (body := self._file()) is None:
+            return
+
+        start, end, status = 0, len(body), 200
+        range_match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if range_match and any(range_match.groups()):
+            first, last = range_match.groups()
+            if not first:
+                # Suffix range, the last bytes of the file
+                start = max(0, len(body) - int(last))
+            else:
+                start = int(first)
+                if last:
+                    end = min(len(body), int(last) + 1)
+
+            if start >= end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self._send_headers(status, body, end - start)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(body)}")
+        self.end_headers()
+
+        with self.server.lock:
+            self.server.in_flight += 1
+        try:
+            self._write_throttled(body[start:end])
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def _write_throttled(self, data):
+        # Chunks are spaced so every connection gets at most the bandwidth
+        chunk_size = 64 * 1024
+        bandwidth = self.server.bandwidth
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i : i + chunk_size]
+            self.wfile.write(chunk)
+            with self.server.lock:
+                self.server.bytes_sent += len(chunk)
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local stand-in for data.commoncrawl.org.
+
+    latency is added before every response in seconds, bandwidth caps each
+    connection in bytes/sec (0 for no cap) and failure_rate is the share
+    of requests answered with a 503. With max_in_flight, a GET arriving
+    while that many bodies are being sent is also answered with a 503 and
+    a Retry-After of retry_after seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        files,
+        latency=0.0,
+        bandwidth=0,
+        failure_rate=0.0,
+        seed=0,
+        port=0,
+        max_in_flight=0,
+        retry_after=0,
+    ):
+        self.files = files
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.bytes_sent = 0
+        self.throttled = 0
+        self.not_modified = 0
+        self.started = time.time()
+        self._thread = None
+
+        super().__init__(("127.0.0.1", port), _StandInHandler)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}/"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
@@ -0,0 +1,321 @@
+import json
+import numbers
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from model.training.train import LateralModel, LateralRecommender
+from model.training.trie import PathTrie, TriePredictor
+
+
+class MicroBatcher:
+    """Coalesce requests arriving within max_wait into one handler call.
+
+    The handler gets a list of requests and returns a list of results in
+    the same order, each submit() returns a Future for its own result.
+    """
+
+    def __init__(self, handler, max_batch_size=256, max_wait=0.002):
+        self._handler = handler
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, request):
+        if self._closed:
+            raise Exception("Batcher is closed")
+
+        future = Future()
+        self._queue.put((request, future, time.monotonic()))
+        return future
+
+    def _collect(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+
+        # Counted from the first request's arrival, requests that waited
+        # while the previous batch ran are sent at once
+        batch = [item]
+        deadline = item[2] + self._max_wait
+        while len(batch) < self._max_batch_size:
+            # Past the deadline only what is already queued is taken
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            # Close request, answer what was collected first
+            if item is None:
+                self._queue.put(None)
+                break
+
+            batch.append(item)
+
+        return batch
+
+    def _run(self):
+        while (batch := self._collect()) is not None:
+            requests = [request for request, _, _ in batch]
+            try:
+                results = self._handler(requests)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+
+                # One bad request must not fail the others, each one is
+                # retried alone and only the failing ones get the error
+                for request, future, _ in batch:
+                    try:
+                        future.set_result(self._handler([request])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _check_request(tokens, top_k):
+    # Checked before batching, a bad value would fail the whole batch
+    if isinstance(tokens, str):
+        raise Exception("Tokens must be a list of strings, not a string")
+
+    tokens = list(tokens)
+    if not all(isinstance(token, str) for token in tokens):
+        raise Exception("Tokens must be strings")
+
+    if isinstance(top_k, bool) or not isinstance(top_k, numbers.Integral):
+        raise Exception(f"top_k must be an integer ({top_k!r})")
+    if top_k < 1:
+        raise Exception(f"top_k must be greater than 0 ({top_k})")
+
+    return tokens, int(top_k)
+
+
+class InferenceService:
+    def __init__(
+        self,
+        model_path,
+        vocabulary,
+        max_batch_size=256,
+        max_wait_ms=2,
+    ):
+        self._lateral = None
+        self._hierarchical = None
+        self._trie = None
+        self._batchers = {}
+
+        # Models are loaded once and kept warm for every request
+        if (model_path / "lateral.npz").exists():
+            lateral_model = LateralModel.load(model_path / "lateral.npz", vocabulary)
+            self._lateral = LateralRecommender(lateral_model)
+            self._batchers["lateral"] = MicroBatcher(
+                self._lateral_batch, max_batch_size, max_wait_ms / 1000
+            )
+
+        if (model_path / "hierarchical.keras").exists():
+            # TensorFlow is only imported if there is a model to serve
+            from model.training.hierarchical import HierarchicalPredictor
+
+            self._hierarchical = HierarchicalPredictor(
+                model_path / "hierarchical.keras", vocabulary
+            )
+            # Traced here, not on the first request
+            self._hierarchical.predict_batch([[]])
+            self._batchers["hierarchical"] = MicroBatcher(
+                self._hierarchical_batch, max_batch_size, max_wait_ms / 1000
+            )
+
+        if (model_path / "trie").exists():
+            self._trie = TriePredictor(
+                PathTrie.load(model_path / "trie", vocabulary), vocabulary
+            )
+
+        if not self._batchers and self._trie is None:
+            raise Exception(f"No trained models in ({model_path})")
+
+    @property
+    def models(self):
+        return list(self._batchers) + (["trie"] if self._trie is not None else [])
+
+    def _lateral_batch(self, requests):
+        # The neighbor lists used depend on top_k, one product per top_k
+        results = [None] * len(requests)
+        by_top_k = {}
+        for i, (input_dirs, top_k) in enumerate(requests):
+            by_top_k.setdefault(top_k, []).append(i)
+
+        for top_k, positions in by_top_k.items():
+            recommendations = self._lateral.recommend_batch(
+                [requests[i][0] for i in positions], top_k
+            )
+            for i, recommendation in zip(positions, recommendations):
+                results[i] = recommendation
+
+        return results
+
+    def _hierarchical_batch(self, requests):
+        # One forward pass with the largest top_k, cut per request
+        top_k = max(top_k for _, top_k in requests)
+        predictions = self._hierarchical.predict_batch(
+            [tokens for tokens, _ in requests], top_k
+        )
+        return [
+            prediction[:top_k] for prediction, (_, top_k) in zip(predictions, requests)
+        ]
+
+    def _submit(self, model, request):
+        if model not in self._batchers:
+            raise Exception(f"Model ({model}) is not loaded")
+
+        return self._batchers[model].submit(request)
+
+    def lateral_async(self, input_dirs, top_k=100):
+        input_dirs, top_k = _check_request(input_dirs, top_k)
+        input_dirs = frozenset(d.lower() for d in input_dirs)
+        return self._submit("lateral", (input_dirs, top_k))
+
+    def hierarchical_async(self, path_tokens, top_k=10, backend="lstm"):
+        path_tokens, top_k = _check_request(path_tokens, top_k)
+        if backend == "trie":
+            # Lookups take microseconds, batching would only add latency
+            future = Future()
+            future.set_result(self.trie(path_tokens, top_k))
+            return future
+
+        return self._submit("hierarchical", (path_tokens, top_k))
+
+    def lateral(self, input_dirs, top_k=100):
+        return self.lateral_async(input_dirs, top_k).result()
+
+    def hierarchical(self, path_tokens, top_k=10, backend="lstm"):
+        if backend == "trie":
+            return self.trie(path_tokens, top_k)
+
+        return self.hierarchical_async(path_tokens, top_k).result()
+
+    def trie(self, path_tokens, top_k=10):
+        if self._trie is None:
+            raise Exception("Model (trie) is not loaded")
+
+        path_tokens, top_k = _check_request(path_tokens, top_k)
+
+        return self._trie.predict(path_tokens, top_k)
+
+    def close(self):
+        for batcher in self._batchers.values():
+            batcher.close()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive and no Nagle delay, small requests are latency bound
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _send_json(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": f"Unknown path ({self.path})"})
+            return
+
+        self._send_json(200, {"models": self.server.service.models})
+
+    def do_POST(self):
+        service = self.server.service
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+
+            match self.path:
+                case "/lateral":
+                    result = service.lateral(body["dirs"], body.get("top_k", 100))
+                case "/hierarchical":
+                    result = service.hierarchical(
+                        body["path"],
+                        body.get("top_k", 10),
+                        body.get("backend", "lstm"),
+                    )
+                case _:
+                    self._send_json(404, {"error": f"Unknown path ({self.path})"})
+                    return
+        except Exception as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        self._send_json(200, {"predictions": result})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixRequestHandler(_RequestHandler):
+    # TCP_NODELAY does not exist for unix sockets
+    disable_nagle_algorithm = False
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_handler = _RequestHandler
+
+    def __init__(self, server_address, service):
+        self.service = service
+        super().__init__(server_address, self.request_handler)
+
+
+class _UnixHTTPServer(_HTTPServer):
+    address_family = socket.AF_UNIX
+    request_handler = _UnixRequestHandler
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+def create_server(service, host="127.0.0.1", port=8765, unix_socket=None):
+    """HTTP server answering POST /lateral and POST /hierarchical.
+
+    Binds to the unix socket path if one is given, otherwise to host:port.
+    Call serve_forever() on the result to start answering.
+    """
+    if unix_socket is None:
+        return _HTTPServer((host, port), service)
+
+    # A socket file left by a previous run would make bind fail
+    if os.path.exists(unix_socket):
+        os.unlink(unix_socket)
+
+    return _UnixHTTPServer(str(unix_socket), service)
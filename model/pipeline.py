@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# Bumped when the state file changes
+PIPELINE_FORMAT = 2
+
+# Keys remembered per stage, the oldest ones are forgotten with their
+# cached outputs
+MAX_STAGE_KEYS = 4
+
+
+def content_hash(data):
+    # Same data gives the same key whatever the order of dict keys
+    data_json = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(data_json.encode()).hexdigest()[:16]
+
+
+def directory_signature(path, pattern="*"):
+    # Names, sizes and modification times, no file is read
+    if not path.exists():
+        return {}
+
+    signature = {}
+    for f in sorted(path.glob(pattern)):
+        stat = f.stat()
+        signature[f.name] = [stat.st_size, stat.st_mtime_ns]
+
+    return signature
+
+
+def file_signature(path):
+    # Content hash of a small file such as a manifest, None if missing
+    if not path.exists():
+        return None
+
+    return hashlib.sha256(path.read_bytes()).hexdigest()[:16]
+
+
+def output_signature(path):
+    if path.is_dir():
+        return directory_signature(path)
+
+    return file_signature(path)
+
+
+def _copy_output(src, dest):
+    # Copied, never linked, stages overwrite their outputs in place
+    tmp_path = dest.with_name(dest.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.unlink(missing_ok=True)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+
+    if src.is_dir():
+        shutil.copytree(src, tmp_path)
+        shutil.rmtree(dest, ignore_errors=True)
+    else:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+
+class Pipeline:
+    """Run stages only when the hash of their inputs changed.
+
+    Every key a stage finished with is kept in the state file with the
+    signatures of the outputs it wrote. A stage is skipped if it already
+    ran with the same key and its outputs are still the ones written then.
+    Stages run with cache=True also keep a copy of their outputs per key,
+    going back to earlier inputs restores them instead of recomputing.
+    """
+
+    def __init__(self, state_path):
+        self._state_path = state_path
+        self._cache_path = state_path.with_name(state_path.stem + "_cache")
+        self._state = {"format": PIPELINE_FORMAT, "stages": {}}
+
+        if state_path.exists():
+            try:
+                with open(state_path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+
+            # State of another format is dropped, every stage runs again
+            if state.get("format") == PIPELINE_FORMAT:
+                self._state = state
+
+    def _is_fresh(self, stage, key, outputs):
+        run = stage["keys"].get(key)
+        if run is None:
+            return False
+
+        # A run with other inputs may have overwritten the outputs since
+        return all(
+            output.exists()
+            and run["outputs"].get(str(output)) == output_signature(output)
+            for output in outputs
+        )
+
+    def _restore(self, name, stage, key, outputs):
+        run = stage["keys"].get(key)
+        if run is None or not run.get("cached"):
+            return False
+
+        key_path = self._cache_path / name / key
+        cached = [key_path / str(i) for i in range(len(outputs))]
+        if not all(cached_path.exists() for cached_path in cached):
+            return False
+
+        for cached_path, output in zip(cached, outputs):
+            _copy_output(cached_path, output)
+
+        run["outputs"] = {str(output): output_signature(output) for output in outputs}
+        return True
+
+    def _snapshot(self, name, key, outputs):
+        key_path = self._cache_path / name / key
+        for i, output in enumerate(outputs):
+            _copy_output(output, key_path / str(i))
+
+    def _save(self):
+        self._state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._state_path.with_name(self._state_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._state, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self._state_path)
+
+    def run_stage(self, name, inputs, run, outputs=(), force=False, cache=False):
+        key = content_hash({"format": PIPELINE_FORMAT, "inputs": inputs})
+        stage = self._state["stages"].setdefault(name, {"key": None, "keys": {}})
+        if force:
+            return self._run(name, stage, key, run, outputs, cache)
+
+        if self._is_fresh(stage, key, outputs):
+            restored = False
+        elif self._restore(name, stage, key, outputs):
+            restored = True
+        else:
+            return self._run(name, stage, key, run, outputs, cache)
+
+        if restored or stage["key"] != key:
+            stage["key"] = key
+            self._save()
+        return {"stage": name, "key": key, "ran": False, "restored": restored}
+
+    def _run(self, name, stage, key, run, outputs, cache):
+        start_time = time.time()
+        try:
+            succeeded = run() is not False
+        except Exception as e:
+            raise Exception(f"Pipeline stage ({name}) failed: {e}") from e
+        if not succeeded:
+            raise Exception(f"Pipeline stage ({name}) failed")
+
+        # Recorded only once the stage finished, a failed run is retried
+        if cache:
+            self._snapshot(name, key, outputs)
+
+        stage["key"] = key
+        stage["keys"][key] = {
+            "outputs": {str(output): output_signature(output) for output in outputs},
+            "cached": cache,
+            "started": start_time,
+            "finished": time.time(),
+        }
+
+        # The oldest keys are forgotten with their cached outputs
+        while len(stage["keys"]) > MAX_STAGE_KEYS:
+            oldest = min(stage["keys"], key=lambda k: stage["keys"][k]["finished"])
+            stage["keys"].pop(oldest)
+            shutil.rmtree(self._cache_path / name / oldest, ignore_errors=True)
+        self._save()
+
+        return {"stage": name, "key": key, "ran": True, "restored": False}
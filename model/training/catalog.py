@@ -0,0 +1,245 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+
+class Catalog:
+    def __init__(self, catalog_path, lists_path, datasets_path):
+        self._catalog_path = catalog_path
+        self._journal_path = catalog_path.with_suffix(".journal")
+        self._lists_path = lists_path
+        self._datasets_path = datasets_path
+        self._lock = threading.Lock()
+
+        # list stem -> list file name
+        self._lists = {}
+        # dataset dir name -> {file name: [size, mtime_ns]}
+        self._datasets = {}
+        # file id -> {dataset dir name: file name}
+        self._file_index = {}
+        # directory -> mtime_ns after the last change the catalog knows about
+        self._mtimes = {}
+
+        self._load()
+        self.reconcile()
+
+    def _load(self):
+        if self._catalog_path.exists():
+            # A broken snapshot just means a full rescan
+            try:
+                with open(self._catalog_path, "r", encoding="utf-8") as f:
+                    snapshot = json.load(f)
+                self._lists = snapshot["lists"]
+                self._datasets = snapshot["datasets"]
+                self._mtimes = snapshot["mtimes"]
+            except (OSError, ValueError, KeyError):
+                self._lists, self._datasets, self._mtimes = {}, {}, {}
+
+        for dataset_name, files in self._datasets.items():
+            for file_name in files:
+                self._index(dataset_name, file_name)
+
+        if not self._journal_path.exists():
+            return
+
+        # Replay the changes made since the last snapshot
+        with open(self._journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line may be cut short by a crash
+                    break
+                self._apply(entry)
+
+    def _save(self):
+        snapshot = {
+            "lists": self._lists,
+            "datasets": self._datasets,
+            "mtimes": self._mtimes,
+        }
+
+        tmp_path = self._catalog_path.with_name(self._catalog_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self._catalog_path)
+
+        # Every journal entry is part of the snapshot now
+        self._journal_path.unlink(missing_ok=True)
+
+    def _index(self, dataset_name, file_name):
+        file_id = Path(file_name).stem
+        self._file_index.setdefault(file_id, {})[dataset_name] = file_name
+
+    def _unindex(self, dataset_name, file_name):
+        file_id = Path(file_name).stem
+        dataset_names = self._file_index.get(file_id, {})
+        dataset_names.pop(dataset_name, None)
+        if not dataset_names:
+            self._file_index.pop(file_id, None)
+
+    def _apply(self, entry):
+        match entry["op"]:
+            case "add_list":
+                self._lists[entry["stem"]] = entry["file"]
+            case "remove_list":
+                self._lists.pop(entry["stem"], None)
+            case "add_dataset":
+                self._datasets.setdefault(entry["dataset"], {})
+            case "remove_dataset":
+                for file_name in self._datasets.pop(entry["dataset"], {}):
+                    self._unindex(entry["dataset"], file_name)
+                self._mtimes.pop(entry["dataset"], None)
+            case "add_file":
+                files = self._datasets.setdefault(entry["dataset"], {})
+                files[entry["file"]] = entry["stat"]
+                self._index(entry["dataset"], entry["file"])
+            case "remove_file":
+                self._datasets.get(entry["dataset"], {}).pop(entry["file"], None)
+                self._unindex(entry["dataset"], entry["file"])
+
+        self._mtimes.update(entry.get("mtimes", {}))
+
+    def _commit(self, entry, mtime_dirs):
+        with self._lock:
+            # Directory mtimes after the change let startup skip untouched dirs
+            entry["mtimes"] = {
+                key: path.stat().st_mtime_ns
+                for key, path in mtime_dirs.items()
+                if path.exists()
+            }
+            self._apply(entry)
+
+            with open(self._journal_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def _scan_dataset(self, dataset_name):
+        for file_name in self._datasets.get(dataset_name, {}):
+            self._unindex(dataset_name, file_name)
+
+        files = {}
+        for f in (self._datasets_path / dataset_name).iterdir():
+            if not f.is_file() or f.suffix == ".part":
+                continue
+            file_stat = f.stat()
+            files[f.name] = [file_stat.st_size, file_stat.st_mtime_ns]
+            self._index(dataset_name, f.name)
+
+        self._datasets[dataset_name] = files
+
+    def _files_changed(self, dataset_name):
+        # A file rewritten in place leaves the directory mtime as it was
+        dataset_path = self._datasets_path / dataset_name
+        for file_name, stat in self._datasets[dataset_name].items():
+            try:
+                file_stat = (dataset_path / file_name).stat()
+            except FileNotFoundError:
+                return True
+            if [file_stat.st_size, file_stat.st_mtime_ns] != stat:
+                return True
+
+        return False
+
+    def reconcile(self, full=False):
+        with self._lock:
+            changed = full or self._journal_path.exists()
+
+            # Directory mtimes are read before listing so a change made
+            # during the scan is caught on the next reconcile
+            lists_mtime = self._lists_path.stat().st_mtime_ns
+            if full or self._mtimes.get("lists") != lists_mtime:
+                self._lists = {
+                    f.stem: f.name
+                    for f in self._lists_path.iterdir()
+                    if f.is_file() and f.suffix != ".part"
+                }
+                self._mtimes["lists"] = lists_mtime
+                changed = True
+
+            datasets_mtime = self._datasets_path.stat().st_mtime_ns
+            if full or self._mtimes.get("datasets") != datasets_mtime:
+                dataset_names = {
+                    f.name for f in self._datasets_path.iterdir() if f.is_dir()
+                }
+                for dataset_name in set(self._datasets) - dataset_names:
+                    self._apply({"op": "remove_dataset", "dataset": dataset_name})
+                for dataset_name in dataset_names - set(self._datasets):
+                    self._datasets[dataset_name] = {}
+                self._mtimes["datasets"] = datasets_mtime
+                changed = True
+
+            # Only datasets modified outside the collector are rescanned, a
+            # stat per known file is much cheaper than listing and reindexing
+            for dataset_name in self._datasets:
+                dataset_path = self._datasets_path / dataset_name
+                dataset_mtime = dataset_path.stat().st_mtime_ns
+                if (
+                    full
+                    or self._mtimes.get(dataset_name) != dataset_mtime
+                    or self._files_changed(dataset_name)
+                ):
+                    self._scan_dataset(dataset_name)
+                    self._mtimes[dataset_name] = dataset_mtime
+                    changed = True
+
+            if changed:
+                self._save()
+
+    def add_list(self, list_stem, file_name):
+        entry = {"op": "add_list", "stem": list_stem, "file": file_name}
+        self._commit(entry, {"lists": self._lists_path})
+
+    def remove_list(self, list_stem):
+        entry = {"op": "remove_list", "stem": list_stem}
+        self._commit(entry, {"lists": self._lists_path})
+
+    def add_dataset(self, dataset_name):
+        entry = {"op": "add_dataset", "dataset": dataset_name}
+        self._commit(
+            entry,
+            {
+                "datasets": self._datasets_path,
+                dataset_name: self._datasets_path / dataset_name,
+            },
+        )
+
+    def remove_dataset(self, dataset_name):
+        entry = {"op": "remove_dataset", "dataset": dataset_name}
+        self._commit(entry, {"datasets": self._datasets_path})
+
+    def add_file(self, dataset_name, file_path):
+        file_stat = file_path.stat()
+        entry = {
+            "op": "add_file",
+            "dataset": dataset_name,
+            "file": file_path.name,
+            "stat": [file_stat.st_size, file_stat.st_mtime_ns],
+        }
+        self._commit(entry, {dataset_name: self._datasets_path / dataset_name})
+
+    def remove_file(self, dataset_name, file_name):
+        entry = {"op": "remove_file", "dataset": dataset_name, "file": file_name}
+        self._commit(entry, {dataset_name: self._datasets_path / dataset_name})
+
+    def get_lists(self):
+        return list(self._lists)
+
+    def list_path(self, list_stem):
+        file_name = self._lists.get(list_stem)
+        return self._lists_path / file_name if file_name else None
+
+    def get_datasets(self):
+        return list(self._datasets)
+
+    def has_dataset(self, dataset_name):
+        return dataset_name in self._datasets
+
+    def dataset_files(self, dataset_name):
+        return list(self._datasets.get(dataset_name, {}))
+
+    def file_paths(self, file_id):
+        return [
+            self._datasets_path / dataset_name / file_name
+            for dataset_name, file_name in self._file_index.get(file_id, {}).items()
+        ]
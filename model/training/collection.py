@@ -1,23 +1,126 @@
 import requests
-import gzip
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import zlib
 import shutil
 from pathlib import Path
 from urllib.parse import urlparse
 import hashlib
 import secrets
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from model.training.catalog import Catalog
+from model.training.metadata_cache import MetadataCache
+from model.training.scheduler import (
+    RETRY_STATUSES,
+    THROTTLE_STATUSES,
+    FetchScheduler,
+    RetryableStatus,
+    parse_retry_after,
+)
+from model.utils.metrics import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, files are copied there instead
+    fcntl = None
+
+# Linux ioctl to clone a file on copy-on-write filesystems (btrfs, xfs)
+_FICLONE = 0x40049409
+
+
+def _record_response(response, method):
+    # Time to headers, and the retries urllib3 made before this response
+    metrics.observe(
+        "collector_request", response.elapsed.total_seconds(), method=method
+    )
+    metrics.count("collector_requests", method=method, status=response.status_code)
+
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        metrics.count("collector_retries", len(retries.history), method=method)
+
+
+def _content_range_total(content_range):
+    # "bytes 100-199/200" or "bytes */200"
+    if not content_range or "/" not in content_range:
+        return None
+
+    total = content_range.rsplit("/", 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+
+def _link_file(src_path, dest_path):
+    # Never overwrite, the destination may share its data with other datasets
+    if dest_path.exists():
+        raise FileExistsError(f"File already exists ({dest_path})")
+
+    # Hardlink first, then a copy-on-write clone, then a full copy
+    try:
+        os.link(src_path, dest_path)
+        return
+    except OSError:
+        pass
+
+    if fcntl is not None:
+        try:
+            with open(src_path, "rb") as f_src, open(dest_path, "xb") as f_dest:
+                fcntl.ioctl(f_dest.fileno(), _FICLONE, f_src.fileno())
+            return
+        except OSError:
+            dest_path.unlink(missing_ok=True)
+
+    shutil.copy(src_path, dest_path)
 
 
 # TODO: Method to validate data lists and datasets
 class DataCollector:
-    def __init__(self, output_data_path):
+    def __init__(
+        self,
+        output_data_path,
+        pool_size=10,
+        max_retries=3,
+        backoff_factor=0.5,
+        metadata_ttl=7 * 24 * 60 * 60,
+        max_bytes_per_sec=0,
+        projected_columns=None,
+    ):
         self._output_data_path = output_data_path
         self._dataset_data_path = output_data_path / "datasets"
         self._data_lists_path = output_data_path / "lists"
-        self._data_lists_downloaded = []
-        self._datasets_downloaded = {}
+        self._max_retries = max_retries
+        self._pool_size = pool_size
+
+        # Only these columns of the dataset files are fetched, None is all
+        self._projected_columns = projected_columns
+        self._session = self._create_session(pool_size, max_retries, backoff_factor)
+
+        # Dataset files go through the scheduler, it sees every 429 and 503
+        self._fetch_session = self._create_session(pool_size, 0, backoff_factor)
+        self._scheduler = FetchScheduler(
+            max_concurrency=pool_size,
+            max_bytes_per_sec=max_bytes_per_sec,
+            backoff_factor=backoff_factor,
+        )
+        self._metadata_cache = MetadataCache(
+            output_data_path / "metadata.json", metadata_ttl
+        )
+
+        # Set on Ctrl+C, running downloads stop at their next chunk
+        self._stop_downloads = threading.Event()
 
         self._check_dir_struct()
-        self.update_db()
+
+        # Reconciled with the disk once, then kept up to date in place
+        self._catalog = Catalog(
+            output_data_path / "catalog.json",
+            self._data_lists_path,
+            self._dataset_data_path,
+        )
 
     def _check_dir_struct(self):
         if not self._output_data_path.exists():
@@ -27,92 +130,381 @@ class DataCollector:
         self._dataset_data_path.mkdir(exist_ok=True)
         self._data_lists_path.mkdir(exist_ok=True)
 
-    def _download_file(self, url, output_path, progress=None, task_msg=""):
+    def _create_session(self, pool_size, max_retries, backoff_factor):
+        # Keep-alive connections are reused by every request of the collector
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("HEAD", "GET"),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def close(self):
+        self._session.close()
+        self._fetch_session.close()
+
+    def _download_file(
+        self,
+        url,
+        output_path,
+        progress=None,
+        task_msg="",
+        hide_task=False,
+        checksum=None,
+        scheduler=None,
+        dest_name=None,
+    ):
+        # The final name is known up front, the .part is renamed only once
         url_parsed = urlparse(url)
-        filename = Path(url_parsed.path).name
+        filename = dest_name or Path(url_parsed.path).name
         dest_path = self._output_data_path / output_path / filename
 
-        with requests.get(url, stream=True) as r:
+        # Data is written to a .part file and only renamed once complete
+        part_path = dest_path.with_name(dest_path.name + ".part")
+
+        # Resume from the bytes already on disk
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        # Without retries of its own, a stalled read fails instead of hanging
+        session = self._session
+        timeout = None
+        if scheduler is not None:
+            session, timeout = self._fetch_session, 30
+
+        with session.get(url, stream=True, headers=headers, timeout=timeout) as r:
+            _record_response(r, "GET")
+            if r.status_code == 416:
+                # Nothing left to fetch if the .part already has every byte
+                total = _content_range_total(r.headers.get("Content-Range"))
+                if total is None or total != offset:
+                    # The remote file changed since the .part was written, the
+                    # retry starts over from the first byte
+                    part_path.unlink(missing_ok=True)
+                    raise RetryableStatus(url, r.status_code)
+                return self._finalize_download(part_path, dest_path, total, checksum)
+
+            if r.status_code in RETRY_STATUSES:
+                retry_after = parse_retry_after(r.headers.get("Retry-After"))
+                raise RetryableStatus(url, r.status_code, retry_after)
+
             r.raise_for_status()
 
+            # Server ignored the Range header, start again from scratch
+            if r.status_code != 206:
+                offset = 0
+
             # Try to get total size for progress bar (may be None)
             total = None
             try:
-                total_header = r.headers.get("Content-Length")
-                if total_header:
-                    total = int(total_header)
+                if r.status_code == 206:
+                    total = _content_range_total(r.headers.get("Content-Range"))
+                else:
+                    total_header = r.headers.get("Content-Length")
+                    if total_header:
+                        total = int(total_header)
             except Exception:
                 total = None
 
             # Setup progress/task if requested
+            task = None
             if progress is not None:
-                task = progress.add_task(task_msg, total=total)
-
-            # Stream and write chunks, updating progress if provided
-            with open(dest_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if not chunk:
-                        continue
-                    f.write(chunk)
-                    if progress is not None and task is not None:
-                        try:
-                            progress.update(task, advance=len(chunk))
-                        except Exception:
-                            # ignore progress errors to not break download
-                            pass
+                task = progress.add_task(task_msg, total=total, completed=offset)
 
-        return dest_path
+            completed = False
+            try:
+                # Stream and write chunks, updating progress if provided
+                received, write_seconds = 0, 0.0
+                start_time = time.perf_counter()
+                with open(part_path, "ab" if offset else "wb") as f:
+                    for chunk in r.iter_content(chunk_size=8192):
+                        if self._stop_downloads.is_set():
+                            raise Exception(f"Download cancelled ({url})")
+                        if not chunk:
+                            continue
+                        write_start = time.perf_counter()
+                        f.write(chunk)
+                        write_seconds += time.perf_counter() - write_start
+                        received += len(chunk)
+                        if scheduler is not None:
+                            scheduler.consume(len(chunk))
+                        if progress is not None and task is not None:
+                            try:
+                                progress.update(task, advance=len(chunk))
+                            except Exception:
+                                # ignore progress errors to not break download
+                                pass
+
+                # Network time is the download time minus the time spent writing
+                metrics.count("collector_bytes", received, kind="dataset")
+                metrics.observe(
+                    "collector_download",
+                    time.perf_counter() - start_time,
+                    kind="dataset",
+                )
+                metrics.observe("collector_disk_write", write_seconds, kind="dataset")
+                completed = True
+            finally:
+                # A failed attempt drops its task, the retry adds a new one
+                if task is not None and not completed:
+                    progress.remove_task(task)
+                # Finished tasks are hidden so concurrent downloads do not
+                # flood the display
+                elif task is not None and hide_task:
+                    progress.update(task, visible=False)
+
+        return self._finalize_download(part_path, dest_path, total, checksum)
+
+    def _schedule(self, download):
+        attempt = 0
+        while True:
+            with self._scheduler.slot() as started:
+                if self._stop_downloads.is_set():
+                    raise Exception("Download cancelled")
+                try:
+                    download_path = download()
+                    self._scheduler.on_success()
+                    return download_path
+                except Exception as e:
+                    error = e
+
+            # A full download resumes its .part file, a projection starts over
+            attempt += 1
+            self._stop_downloads.wait(self._retry_delay(error, started, attempt))
+
+    def _retry_delay(self, error, started, attempt):
+        # Seconds to wait before the next attempt, other errors are raised
+        if isinstance(error, RetryableStatus):
+            retry_after = error.retry_after
+            throttled = error.status in THROTTLE_STATUSES
+        elif isinstance(error, requests.RequestException) and not isinstance(
+            error, requests.HTTPError
+        ):
+            # Resets and timeouts are a sign of overload too
+            retry_after, throttled = None, True
+        else:
+            raise error
 
-    def _uncompress_gz(self, input_path):
-        input_path = self._output_data_path / input_path
+        if throttled:
+            self._scheduler.on_throttle(started, retry_after)
+            metrics.count("collector_throttled", kind="dataset")
 
-        # Remove only the last .gz extension
-        if input_path.suffix == ".gz":
-            output_path = input_path.with_suffix("")
-        else:
-            # remove .gz from the end of the name if present
-            output_path = Path(str(input_path).replace(".gz", "", 1))
+        if attempt > self._max_retries:
+            raise error
 
-        with gzip.open(input_path, "rb") as f_in:
-            with open(output_path, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        input_path.unlink()
+        metrics.count("collector_retries", method="GET")
+        return max(self._scheduler.backoff(attempt), retry_after or 0)
 
-        return output_path
+    def _fetch_range_retrying(self, url, byte_range):
+        # The slot is kept while waiting, the rest of the projection is not lost
+        attempt = 0
+        while True:
+            if self._stop_downloads.is_set():
+                raise Exception(f"Download cancelled ({url})")
 
-    def update_db(self):
-        # Read downloaded lists
-        self._data_lists_downloaded = [
-            f for f in self._data_lists_path.iterdir() if f.is_file()
-        ]
+            started = time.monotonic()
+            try:
+                return self._fetch_range(url, byte_range)
+            except Exception as e:
+                error = e
+
+            attempt += 1
+            self._stop_downloads.wait(self._retry_delay(error, started, attempt))
+
+    def _fetch_range(self, url, byte_range):
+        r = self._fetch_session.get(
+            url, headers={"Range": f"bytes={byte_range}"}, timeout=30
+        )
+        _record_response(r, "GET")
+
+        if r.status_code in RETRY_STATUSES:
+            retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            raise RetryableStatus(url, r.status_code, retry_after)
+
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise Exception(f"Server does not support range requests ({url})")
+
+        self._scheduler.consume(len(r.content))
+        return r.content, _content_range_total(r.headers.get("Content-Range"))
+
+    def _download_projected(
+        self,
+        url,
+        output_path,
+        columns,
+        progress=None,
+        task_msg="",
+        hide_task=False,
+        dest_name=None,
+    ):
+        from model.training.remote_parquet import (
+            FOOTER_READ_SIZE,
+            RangeReader,
+            write_projection,
+        )
+
+        filename = dest_name or Path(urlparse(url).path).name
+        dest_path = self._output_data_path / output_path / filename
+
+        # Never the .part name of full downloads, they would append raw bytes
+        # to a slim file when resuming it
+        part_path = dest_path.with_name(dest_path.name + ".projected.part")
+
+        # A suffix range returns the footer, and the file size in Content-Range
+        start_time = time.perf_counter()
+        tail, size = self._fetch_range_retrying(url, f"-{FOOTER_READ_SIZE}")
+        if size is None:
+            raise Exception(f"Unknown size of remote file ({url})")
+
+        reader = RangeReader(
+            lambda start, end: self._fetch_range_retrying(url, f"{start}-{end - 1}")[0],
+            size,
+            tail,
+        )
+
+        task = None
+        if progress is not None:
+            task = progress.add_task(task_msg, total=None)
+
+        def on_row_group(done, total):
+            if task is not None:
+                progress.update(task, completed=done, total=total)
+
+        # Only the column chunks of the projected columns are fetched. A
+        # projection cannot be resumed, a failed one is deleted
+        try:
+            write_projection(reader, columns, part_path, on_row_group)
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            if task is not None:
+                progress.remove_task(task)
+            raise
+
+        received = len(tail) + reader.fetched
+        metrics.count("collector_bytes", received, kind="projected")
+        metrics.count("collector_skipped_bytes", max(0, size - received))
+        metrics.observe(
+            "collector_download", time.perf_counter() - start_time, kind="projected"
+        )
 
-        # Read downloaded datasets as a dict
-        self._datasets_downloaded = {}
-        datasets_dirs = [f for f in self._dataset_data_path.iterdir() if f.is_dir()]
-        for dataset_dir in datasets_dirs:
-            files = [f for f in dataset_dir.iterdir() if f.is_file()]
-            self._datasets_downloaded[dataset_dir.name] = files
+        if hide_task and task is not None:
+            progress.update(task, visible=False)
+
+        return self._finalize_download(part_path, dest_path)
+
+    def _can_link(self, file_path):
+        from model.training.remote_parquet import projected_columns
+
+        # Complete files stand in for any projection, slim ones only for theirs
+        file_columns = projected_columns(file_path)
+        if file_columns is None:
+            return True
+
+        return self._projected_columns is not None and set(
+            self._projected_columns
+        ) <= set(file_columns)
+
+    def _finalize_download(self, part_path, dest_path, total=None, checksum=None):
+        # Keep the .part file so the next attempt can resume it
+        part_size = part_path.stat().st_size
+        if total is not None and part_size != total:
+            raise Exception(
+                f"Incomplete download ({part_path.name}: {part_size} of {total} bytes)"
+            )
+
+        # checksum is an (algorithm, hexdigest) tuple, e.g. ("sha256", "ab12...")
+        if checksum is not None:
+            algorithm, expected_digest = checksum
+            file_hash = hashlib.new(algorithm)
+            with metrics.timer("collector_checksum"), open(part_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    file_hash.update(chunk)
+
+            if file_hash.hexdigest() != expected_digest.lower():
+                part_path.unlink()
+                raise Exception(f"Checksum mismatch ({dest_path.name})")
+
+        part_path.replace(dest_path)
+        return dest_path
+
+    def _download_gz_file(self, url, dest_path):
+        # Decompress while downloading so the .gz never touches the disk
+        part_path = dest_path.with_name(dest_path.name + ".part")
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        with self._session.get(url, stream=True, timeout=10) as r:
+            _record_response(r, "GET")
+            r.raise_for_status()
+
+            received, written = 0, 0
+            gunzip_seconds, write_seconds = 0.0, 0.0
+            start_time = time.perf_counter()
+            with open(part_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    received += len(chunk)
+                    while chunk:
+                        gunzip_start = time.perf_counter()
+                        data = decompressor.decompress(chunk)
+                        write_start = time.perf_counter()
+                        f.write(data)
+                        gunzip_seconds += write_start - gunzip_start
+                        write_seconds += time.perf_counter() - write_start
+                        written += len(data)
+
+                        # Concatenated gzip members start a new stream
+                        if not decompressor.eof:
+                            break
+                        chunk = decompressor.unused_data
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                f.write(decompressor.flush())
+
+            metrics.count("collector_bytes", received, kind="list")
+            metrics.count("collector_gunzip_bytes", written)
+            metrics.observe(
+                "collector_download", time.perf_counter() - start_time, kind="list"
+            )
+            metrics.observe("collector_gunzip", gunzip_seconds)
+            metrics.observe("collector_disk_write", write_seconds, kind="list")
+
+        part_path.replace(dest_path)
+        return dest_path
+
+    def update_db(self):
+        # Full rescan, only needed if files were changed outside the collector
+        self._catalog.reconcile(full=True)
 
     def download_data_list(self, list_url):
         url_hash = hashlib.md5(list_url.encode()).hexdigest()
 
         # Check if the list already exists
-        for file_path in self._data_lists_downloaded:
-            filename = file_path.stem
-            if url_hash == filename:
-                return url_hash
-
-        # Download list
-        saved_file_path = self._download_file(list_url, "./")
+        if url_hash in self.get_lists():
+            return url_hash
 
-        # Uncompress list
-        saved_file_path = self._uncompress_gz(saved_file_path)
+        # Name the file with the hash of the url, without the .gz extension
+        filename = Path(urlparse(list_url).path).name
+        suffix = Path(filename.removesuffix(".gz")).suffix
+        new_path = self._data_lists_path / (url_hash + suffix)
 
-        # Rename file to the hash of the url and move to lists/
-        new_path = self._data_lists_path / (url_hash + str(saved_file_path.suffix))
-        saved_file_path.rename(new_path)
+        # Download and uncompress list in a single pass
+        if filename.endswith(".gz"):
+            self._download_gz_file(list_url, new_path)
+        else:
+            self._download_file(
+                list_url, self._data_lists_path, dest_name=new_path.name
+            )
 
-        self.update_db()
+        self._catalog.add_list(url_hash, new_path.name)
 
         return url_hash
 
@@ -120,24 +512,26 @@ class DataCollector:
         if data_list_stem not in self.get_lists():
             return False
 
-        for path in self._data_lists_downloaded:
-            if path.stem == data_list_stem:
-                data_list_path = path
-                break
-
+        data_list_path = self._catalog.list_path(data_list_stem)
         data_list_path.unlink()
 
-        self.update_db()
+        self._catalog.remove_list(data_list_stem)
         return True
 
-    def get_data_list(self, list_file_stem):
-        for list_path in self._data_lists_downloaded:
-            if list_file_stem == list_path.stem:
-                with open(list_path, "r") as f:
-                    return [
-                        line.replace("\n", "") for line in f if "subset=warc" in line
-                    ]
-        return False
+    def get_data_list(self, list_file_stem, lazy=False):
+        list_path = self._catalog.list_path(list_file_stem)
+        if list_path is None:
+            return False
+
+        # Lazy mode yields paths one by one instead of holding the whole list
+        data_list_paths = self._iter_data_list(list_path)
+        return data_list_paths if lazy else list(data_list_paths)
+
+    def _iter_data_list(self, list_path):
+        with open(list_path, "r") as f:
+            for line in f:
+                if "subset=warc" in line:
+                    yield line.replace("\n", "")
 
     def create_dataset(self):
         random_bytes = secrets.token_bytes(16)
@@ -145,18 +539,25 @@ class DataCollector:
         dataset_path = self._dataset_data_path / dir_name
         dataset_path.mkdir()
 
-        self.update_db()
+        self._catalog.add_dataset(dir_name)
         return dataset_path.name
 
     def remove_dataset(self, dataset_dir_name):
         del_path = self._dataset_data_path / dataset_dir_name
         shutil.rmtree(del_path)
 
-        self.update_db()
+        self._catalog.remove_dataset(dataset_dir_name)
         return True
 
     def download_dataset(
-        self, base_url, path, dataset_dir_name, progress=None, task_msg=""
+        self,
+        base_url,
+        path,
+        dataset_dir_name,
+        progress=None,
+        task_msg="",
+        hide_task=False,
+        checksum=None,
     ):
         path = path.strip()
         base_url = base_url.strip()
@@ -166,36 +567,136 @@ class DataCollector:
         if not dataset_output_path.exists():
             raise Exception(f"Dataset does not exist ({dataset_dir_name})")
 
-        dataset_file_id = self.check_url(url, base_url)["list_file_stem"]
-        if not dataset_file_id:
-            raise Exception(f"Url is not valid ({url})")
+        # The id only depends on the url, no request is needed to compute it
+        dataset_file_id = self.list_file_to_id(base_url, [path])[0]
+
+        # Nothing to do if this dataset already has the file
+        for dataset_file in self._catalog.file_paths(dataset_file_id):
+            if dataset_file.parent == dataset_output_path and dataset_file.exists():
+                return
 
         # Check if file already exists
         file_exist = self.get_dataset_file(dataset_file_id)
 
-        if file_exist != False:
-            # Copy file instead of download it
-            shutil.copy(file_exist, dataset_output_path / file_exist.name)
+        if file_exist != False and self._can_link(file_exist):
+            # Link file instead of download it
+            new_path = dataset_output_path / file_exist.name
+            _link_file(file_exist, new_path)
 
-            self.update_db()
+            self._catalog.add_file(dataset_dir_name, new_path)
             return
 
+        # Named after the id from the start, no rename after the download
+        dest_name = dataset_file_id + Path(urlparse(url).path).suffix
+
         # Download dataset
-        download_path = self._download_file(
-            url, dataset_output_path, progress, task_msg
-        )
+        if self._projected_columns is not None:
+            if checksum is not None:
+                raise Exception("Checksums need a full download, not a projection")
+
+            download_path = self._schedule(
+                lambda: self._download_projected(
+                    url,
+                    dataset_output_path,
+                    self._projected_columns,
+                    progress,
+                    task_msg,
+                    hide_task,
+                    dest_name,
+                )
+            )
+        else:
+            download_path = self._schedule(
+                lambda: self._download_file(
+                    url,
+                    dataset_output_path,
+                    progress,
+                    task_msg,
+                    hide_task,
+                    checksum,
+                    self._scheduler,
+                    dest_name,
+                )
+            )
+
+        self._catalog.add_file(dataset_dir_name, download_path)
+
+    def download_dataset_batch(
+        self, base_url, paths, dataset_dir_name, max_workers=4, progress=None
+    ):
+        base_url = base_url.strip()
 
-        # Rename file with id
-        new_path = dataset_output_path / (dataset_file_id + download_path.suffix)
-        download_path.rename(new_path)
+        # A path given twice would put two writers on the same .part file
+        unique_paths = {}
+        for path in paths:
+            path = path.strip()
+            unique_paths.setdefault(self.list_file_to_id(base_url, [path])[0], path)
+        paths = list(unique_paths.values())
 
-        self.update_db()
+        if not (self._dataset_data_path / dataset_dir_name).exists():
+            raise Exception(f"Dataset does not exist ({dataset_dir_name})")
+
+        results = {"downloaded": [], "failed": {}}
+        if not paths:
+            return results
+
+        # One task for the whole batch, the files add their own tasks
+        overall_task = None
+        if progress is not None:
+            overall_task = progress.add_task("Progress", total=len(paths))
+
+        # No probe per file, the size of each task comes from its GET
+        def download(path):
+            file_id = self.list_file_to_id(base_url, [path])[0]
+            task_msg = f"Downloading {file_id}"
+            self.download_dataset(
+                base_url, path, dataset_dir_name, progress, task_msg, hide_task=True
+            )
+
+        # max_workers caps the batch, the scheduler adapts the requests below it
+        self._stop_downloads.clear()
+        executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        try:
+            futures = {executor.submit(download, path): path for path in paths}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = futures[future]
+
+                    # A failed file is recorded and the rest of the batch continues
+                    try:
+                        future.result()
+                        results["downloaded"].append(path)
+                    except Exception as e:
+                        results["failed"][path] = str(e)
+
+                if overall_task is not None:
+                    stats = self._scheduler.stats()
+                    progress.update(
+                        overall_task,
+                        advance=len(done),
+                        description=(
+                            f"Progress ({stats['concurrency']} parallel,"
+                            f" {stats['bytes_per_sec'] / 1e6:.1f} MB/s)"
+                        ),
+                    )
+        except KeyboardInterrupt:
+            # Queued files are dropped, running ones stop at their next chunk
+            # and keep their .part to resume later
+            self._stop_downloads.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            executor.shutdown()
+
+        results["scheduler"] = self._scheduler.stats()
+        return results
 
     def get_dataset_file(self, dataset_file_id):
-        for dataset in self._dataset_data_path.iterdir():
-            for dataset_files in dataset.iterdir():
-                if dataset_files.stem == dataset_file_id:
-                    return dataset_files
+        for dataset_file in self._catalog.file_paths(dataset_file_id):
+            if dataset_file.exists():
+                return dataset_file
 
         return False
 
@@ -206,16 +707,18 @@ class DataCollector:
             raise Exception(f"Invalid file or dataset id ({file_path})")
 
         file_path.unlink()
-        self.update_db()
+        self._catalog.remove_file(dataset_id, file_path.name)
         return True
 
     def downloaded_dataset_files(self, dataset_id):
-        dataset_id_path = self._dataset_data_path / dataset_id
-
-        if not dataset_id_path.exists():
+        if not self._catalog.has_dataset(dataset_id):
             raise Exception(f"Dataset does not exist ({dataset_id})")
 
-        return [file_id.stem for file_id in dataset_id_path.iterdir()]
+        # Unfinished downloads are never part of the catalog
+        return [
+            Path(file_name).stem
+            for file_name in self._catalog.dataset_files(dataset_id)
+        ]
 
     def list_file_to_id(self, base_url, data_list_paths):
         data_list_ids = []
@@ -224,10 +727,16 @@ class DataCollector:
         return data_list_ids
 
     def get_lists(self):
-        return [list.stem for list in self._data_lists_downloaded]
+        return self._catalog.get_lists()
 
     def get_datasets(self):
-        return self._datasets_downloaded
+        return {
+            dataset_name: [
+                self._dataset_data_path / dataset_name / file_name
+                for file_name in self._catalog.dataset_files(dataset_name)
+            ]
+            for dataset_name in self._catalog.get_datasets()
+        }
 
     def check_url(self, url, base_url):
         url = url.rstrip("/")
@@ -235,22 +744,83 @@ class DataCollector:
         if base_url not in url:
             return False
 
+        url_details = self._metadata_cache.get(url)
+        if url_details is None:
+            url_details = self._probe_url(url, self._metadata_cache.stale(url))
+            if not url_details:
+                return False
+
+            self._metadata_cache.set(url, url_details)
+            self._metadata_cache.save()
+
+        response_details = {
+            "list_file_stem": url_details["id"],
+            "size": url_details["size"],
+        }
+
+        return response_details
+
+    def get_remote_metadata(self, urls, max_workers=None):
+        urls = [url.rstrip("/") for url in urls]
+
+        # More threads than pooled connections would discard connections
+        max_workers = min(max_workers or self._pool_size, self._pool_size)
+
+        # Only urls without a fresh cache entry are probed, many at once
+        missing_urls = self._metadata_cache.missing(urls)
+        if missing_urls:
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                probed = executor.map(
+                    self._probe_url,
+                    missing_urls,
+                    [self._metadata_cache.stale(url) for url in missing_urls],
+                )
+                for url, url_details in zip(missing_urls, probed):
+                    if url_details:
+                        self._metadata_cache.set(url, url_details)
+            self._metadata_cache.save()
+
+        return {url: self._metadata_cache.get(url) for url in urls}
+
+    def _probe_url(self, url, cached=None):
+        # An expired entry is revalidated with its validators
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
         try:
-            response = requests.head(url, allow_redirects=True, timeout=10)
+            response = self._session.head(
+                url, headers=headers, allow_redirects=True, timeout=10
+            )
+            _record_response(response, "HEAD")
 
             if response.status_code == 405:  # Method Not Allowed
-                response = requests.get(url, stream=True, timeout=10)
+                response = self._session.get(
+                    url, headers=headers, stream=True, timeout=10
+                )
+                _record_response(response, "GET")
+
+            # Not Modified, the cached details are still right
+            if response.status_code == 304 and headers:
+                return {
+                    key: value for key, value in cached.items() if key != "checked_at"
+                }
 
             if response.status_code == 200:
                 # size = None if Content-Lenght not present
                 size = response.headers.get("Content-Length")
 
-                response_details = {
-                    "list_file_stem": hashlib.md5(url.encode()).hexdigest(),
-                    "size": size,
+                url_details = {
+                    "id": hashlib.md5(url.encode()).hexdigest(),
+                    "size": int(size) if size and size.isdigit() else None,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
                 }
 
-                return response_details
+                return url_details
 
             return False
         except requests.RequestException:
@@ -0,0 +1,20 @@
+# Versions of what the stages write and the defaults that change it. Kept
+# apart from the stage modules so the pipeline can key a stage without
+# importing dask or TensorFlow
+
+# Bumped when the per-file output of preprocess() changes
+PREPROCESS_FORMAT = 1
+
+VOCABULARY_FORMAT = 1
+
+TRIE_FORMAT = 1
+
+# Token filter thresholds, defaults reproduce the notebook pipeline. The
+# notebook defines limit_depth() but never applies it, so max_depth is off
+DEFAULT_TOKEN_PARAMS = {
+    "max_len": 15,
+    "max_depth": None,
+    "max_digits": 6,
+    "digit_ratio": 0.5,
+    "digit_ratio_min_len": 10,
+}
@@ -0,0 +1,186 @@
+import time
+
+import keras
+import numpy as np
+import tensorflow as tf
+
+from model.utils.metrics import metrics
+
+# TensorFlow is only imported by this module, train.py loads it on demand
+
+
+@keras.saving.register_keras_serializable(package="goneuro")
+class SoftmaxOutput(keras.layers.Layer):
+    """Dense output layer returning logits.
+
+    The kernel is stored as (classes, units) so its rows can be looked up
+    by tf.nn.sampled_softmax_loss during sampled training.
+    """
+
+    def __init__(self, num_classes, **kwargs):
+        super().__init__(**kwargs)
+        self.num_classes = num_classes
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(
+            shape=(self.num_classes, input_shape[-1]),
+            initializer="glorot_uniform",
+            name="kernel",
+        )
+        self.bias = self.add_weight(
+            shape=(self.num_classes,), initializer="zeros", name="bias"
+        )
+
+    def call(self, inputs):
+        return tf.matmul(inputs, self.kernel, transpose_b=True) + self.bias
+
+    def get_config(self):
+        return {**super().get_config(), "num_classes": self.num_classes}
+
+
+def build_hierarchical_model(vocab_size, max_len, embedding_dim=32, lstm_units=64):
+    # Same layers as the notebook, the softmax is applied on prediction
+    inputs = keras.Input(shape=(max_len,), dtype="int32")
+    embedded = keras.layers.Embedding(vocab_size, embedding_dim)(inputs)
+    hidden = keras.layers.LSTM(lstm_units, name="lstm")(embedded)
+    logits = SoftmaxOutput(vocab_size, name="output")(hidden)
+
+    return keras.Model(inputs, logits)
+
+
+class HierarchicalTrainer:
+    def __init__(self, model, mode="full", num_sampled=64, learning_rate=1e-3):
+        if mode not in ("full", "sampled"):
+            raise Exception(f"Unknown softmax mode ({mode})")
+
+        self.model = model
+        self.mode = mode
+        self._num_sampled = num_sampled
+        self._optimizer = keras.optimizers.Adam(learning_rate)
+        self._output = model.get_layer("output")
+        self._encoder = keras.Model(model.inputs, model.get_layer("lstm").output)
+
+        self._train_step = tf.function(self._train_step, reduce_retracing=True)
+        self._eval_step = tf.function(self._eval_step, reduce_retracing=True)
+
+    def _loss(self, X, y, training):
+        if self.mode == "sampled" and training:
+            # Only num_sampled negative classes per step instead of the vocab
+            hidden = self._encoder(X, training=True)
+            return tf.nn.sampled_softmax_loss(
+                weights=self._output.kernel,
+                biases=self._output.bias,
+                labels=tf.cast(tf.expand_dims(y, -1), tf.int64),
+                inputs=hidden,
+                num_sampled=self._num_sampled,
+                num_classes=self._output.num_classes,
+            )
+
+        logits = self.model(X, training=training)
+        return tf.nn.sparse_softmax_cross_entropy_with_logits(labels=y, logits=logits)
+
+    def _train_step(self, X, y, sample_weight):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(self._loss(X, y, True) * sample_weight)
+
+        variables = self.model.trainable_variables
+        gradients = tape.gradient(loss, variables)
+        self._optimizer.apply_gradients(zip(gradients, variables))
+        return loss
+
+    def _eval_step(self, X, y, sample_weight):
+        return tf.reduce_mean(self._loss(X, y, False) * sample_weight)
+
+    def _run(self, step, batches, steps, phase):
+        losses = []
+        start_time = time.perf_counter()
+
+        for _, batch in zip(range(steps), batches):
+            X, y = batch[0], batch[1]
+            sample_weight = batch[2] if len(batch) > 2 else np.ones_like(y, "float32")
+            losses.append(float(step(X, y, sample_weight)))
+
+        # An empty generator has no loss to report
+        if not losses:
+            raise Exception(f"No training data ({phase}, {self.mode})")
+
+        seconds = time.perf_counter() - start_time
+        metrics.count("train_steps", len(losses), mode=self.mode, phase=phase)
+        metrics.observe("train_epoch", seconds, mode=self.mode, phase=phase)
+        return {
+            "loss": float(np.mean(losses)),
+            "steps": len(losses),
+            "seconds": seconds,
+            "steps_per_sec": len(losses) / seconds if seconds else 0.0,
+        }
+
+    def train(self, batch_generator, epochs=1, steps_per_epoch=None, callback=None):
+        steps_per_epoch = steps_per_epoch or len(batch_generator)
+        batches = iter(batch_generator)
+
+        history = []
+        for epoch in range(epochs):
+            result = self._run(self._train_step, batches, steps_per_epoch, "train")
+            result = {"epoch": epoch + 1, "mode": self.mode, **result}
+            history.append(result)
+
+            if callback is not None:
+                callback(result)
+
+        return history
+
+    def evaluate(self, batch_generator, steps=None):
+        # Always the full softmax, sampled losses are not comparable
+        return self._run(
+            self._eval_step,
+            batch_generator.epoch(),
+            steps or len(batch_generator),
+            "eval",
+        )
+
+
+class HierarchicalPredictor:
+    def __init__(self, model_path, vocabulary):
+        self._vocabulary = vocabulary
+        self._model = keras.models.load_model(model_path)
+        self.max_len = self._model.input_shape[1]
+
+        if self._model.output_shape[-1] != len(vocabulary):
+            raise Exception(f"Model ({model_path}) uses another vocabulary")
+
+        # One trace for every batch size and top_k, no retracing while serving
+        self._predict = tf.function(
+            self._predict,
+            input_signature=[
+                tf.TensorSpec([None, self.max_len], tf.int32),
+                tf.TensorSpec([], tf.int32),
+            ],
+        )
+
+    def _predict(self, X, top_k):
+        probabilities = tf.nn.softmax(self._model(X, training=False))
+        return tf.math.top_k(probabilities, k=top_k)
+
+    def encode(self, token_lists):
+        # Unknown tokens are dropped, then padded at the front like training
+        X = np.zeros((len(token_lists), self.max_len), dtype=np.int32)
+        for i, tokens in enumerate(token_lists):
+            idx = self._vocabulary.encode([token.lower() for token in tokens])
+            idx = idx[idx != -1][-self.max_len :]
+            if idx.size:
+                X[i, -idx.size :] = idx
+
+        return X
+
+    def predict_batch(self, token_lists, top_k=10):
+        top_k = min(top_k, len(self._vocabulary) - 1)
+        probabilities, idx = self._predict(self.encode(token_lists), top_k)
+
+        return [
+            [
+                (self._vocabulary.idx_to_token[i], float(p))
+                for i, p in zip(row_idx, row_probabilities)
+                if i != 0
+            ]
+            for row_idx, row_probabilities in zip(idx.numpy(), probabilities.numpy())
+        ]
@@ -0,0 +1,59 @@
+import json
+import os
+import time
+
+
+class MetadataCache:
+    def __init__(self, cache_path, ttl=7 * 24 * 60 * 60):
+        self._cache_path = cache_path
+        self._ttl = ttl
+        self._entries = {}
+        self._is_dirty = False
+
+        self._load()
+
+    def _load(self):
+        if not self._cache_path.exists():
+            return
+
+        # A broken cache is rebuilt instead of blocking the collector
+        try:
+            with open(self._cache_path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _is_fresh(self, entry):
+        return time.time() - entry.get("checked_at", 0) < self._ttl
+
+    def get(self, url):
+        entry = self._entries.get(url)
+        if entry is None or not self._is_fresh(entry):
+            return None
+
+        return entry
+
+    def stale(self, url):
+        # Expired entries too, their validators make revalidation cheap
+        return self._entries.get(url)
+
+    def set(self, url, entry):
+        entry = dict(entry)
+        entry["checked_at"] = time.time()
+        self._entries[url] = entry
+        self._is_dirty = True
+
+    def missing(self, urls):
+        return [url for url in urls if self.get(url) is None]
+
+    def save(self):
+        if not self._is_dirty:
+            return
+
+        # Write to a temporary file first so a crash never leaves half a cache
+        tmp_path = self._cache_path.with_name(self._cache_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self._cache_path)
+
+        self._is_dirty = False
@@ -1,22 +1,575 @@
 import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
 from collections import Counter
+from functools import lru_cache
+
+from model.training.formats import DEFAULT_TOKEN_PARAMS, PREPROCESS_FORMAT
+from model.training.vocabulary import EncodedPaths, EncodedPathsWriter, Vocabulary
+from model.utils.metrics import metrics
+
+# Only columns of the cc-index tables used by the models
+DATASET_COLUMNS = ["url_host_registered_domain", "url_path", "fetch_status"]
+
+# 404 responses are pages that do not exist, dropped while reading
+DATASET_FILTERS = [("fetch_status", "!=", 404)]
+
+
+def _char_class(code_points, mask):
+    # RE2 class of the masked code points, as ranges
+    selected = code_points[mask]
+    breaks = np.flatnonzero(np.diff(selected) != 1)
+    starts = selected[np.concatenate(([0], breaks + 1))]
+    ends = selected[np.concatenate((breaks, [selected.size - 1]))]
+    return "".join(
+        f"\\x{{{start:x}}}" if start == end else f"\\x{{{start:x}}}-\\x{{{end:x}}}"
+        for start, end in zip(starts, ends)
+    )
+
+
+@lru_cache(maxsize=None)
+def _str_semantics():
+    """Character classes of Python's str methods for the Arrow kernels.
+
+    RE2's \\w and \\d are ASCII only and utf8_lower may follow another
+    Unicode version, so the classes are built from str itself, once.
+    """
+    # Every character of a valid str, surrogates never reach Arrow
+    code_points = np.arange(sys.maxunicode + 1)
+    code_points = code_points[(code_points < 0xD800) | (code_points > 0xDFFF)]
+    chars = [chr(c) for c in code_points]
+
+    allowed = np.array([c.isalnum() or c in "-_%" for c in chars])
+    digits = np.array([c.isdigit() for c in chars])
+    whitespace = "".join(c for c in chars if c.isspace())
+
+    # Characters utf8_lower maps differently from str.lower(), plus the
+    # sigma whose lower case depends on the characters around it
+    python_lowered = pa.array([c.lower() for c in chars])
+    arrow_lowered = pc.utf8_lower(pa.array(chars))
+    special = pc.not_equal(arrow_lowered, python_lowered).to_numpy(zero_copy_only=False)
+    special |= code_points == 0x03A3
+
+    return {
+        # Same as c.isalnum() or c in "-_%" for every character of the token
+        "allowed_token": f"^[{_char_class(code_points, allowed)}]+$",
+        # Every character for which str.isdigit() is true
+        "digit": f"[{_char_class(code_points, digits)}]",
+        # Characters removed by str.strip()
+        "whitespace": whitespace,
+        "python_lower": f"[{_char_class(code_points, special)}]",
+    }
+
+
+def _lower(paths):
+    lowered = pc.utf8_lower(paths)
+
+    # The few paths with special characters go through str.lower()
+    special = pc.fill_null(
+        pc.match_substring_regex(paths, _str_semantics()["python_lower"]), False
+    )
+    if pc.any(special).as_py():
+        replacements = pa.array(
+            [path.lower() for path in pc.filter(paths, special).to_pylist()],
+            type=paths.type,
+        )
+        lowered = pc.replace_with_mask(lowered, special, replacements)
+
+    return lowered
+
+
+def _filter_tokens(tokens, max_len, max_digits, digit_ratio, digit_ratio_min_len):
+    lengths = pc.utf8_length(tokens).to_numpy()
+
+    # Empty tokens ("a//b") are not directories
+    keep = (lengths > 0) & (lengths <= max_len)
+    keep &= pc.match_substring_regex(
+        tokens, _str_semantics()["allowed_token"]
+    ).to_numpy(zero_copy_only=False)
+
+    # Digit rules only matter for long tokens, the rest skip the regex
+    candidates = np.flatnonzero(keep & (lengths > min(max_digits, digit_ratio_min_len)))
+    if candidates.size:
+        candidate_lengths = lengths[candidates]
+        digit_counts = pc.count_substring_regex(
+            tokens.take(candidates), _str_semantics()["digit"]
+        ).to_numpy()
+
+        # str.isdigit() is true when every character is a digit
+        is_noise = (digit_counts == candidate_lengths) & (
+            candidate_lengths > max_digits
+        )
+        is_noise |= (digit_counts / candidate_lengths >= digit_ratio) & (
+            candidate_lengths > digit_ratio_min_len
+        )
+        keep[candidates[is_noise]] = False
+
+    return keep
+
+
+def _to_arrow(values):
+    array = pa.array(values, from_pandas=True)
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    return array
+
+
+def tokenize_url_paths(url_paths, **token_params):
+    """Split url paths into filtered directory tokens.
+
+    Returns the positions of the rows that kept at least one token and
+    a ListArray with the tokens of each of them, matching the notebook's
+    url_tokenize_pipeline + token_filter_pipeline.
+    """
+    params = {**DEFAULT_TOKEN_PARAMS, **token_params}
+
+    # Arrow kernels, with Python's str semantics (strip, isdigit, \w)
+    url_paths = _lower(_to_arrow(url_paths))
+
+    # Valid paths contain "/" and something besides slashes and whitespace
+    positions = np.flatnonzero(
+        pc.fill_null(pc.match_substring(url_paths, "/"), False).to_numpy(
+            zero_copy_only=False
+        )
+    )
+    cleaned = pc.utf8_trim(url_paths.take(positions), _str_semantics()["whitespace"])
+    cleaned = pc.utf8_trim(cleaned, "/")
+    not_empty = pc.not_equal(cleaned, "").to_numpy(zero_copy_only=False)
+    positions = positions[not_empty]
+    split_paths = pc.split_pattern(cleaned.filter(not_empty), "/")
+
+    # One row per token, remembering the path it came from
+    row_ids = pc.list_parent_indices(split_paths).to_numpy()
+    tokens = pc.list_flatten(split_paths)
+
+    keep = _filter_tokens(
+        tokens,
+        params["max_len"],
+        params["max_digits"],
+        params["digit_ratio"],
+        params["digit_ratio_min_len"],
+    )
+
+    # Depth cap keeps the first tokens of each path
+    if params["max_depth"] is not None:
+        kept_rows = row_ids[keep]
+        depth = np.arange(kept_rows.size) - np.searchsorted(kept_rows, kept_rows)
+        keep[np.flatnonzero(keep)[depth >= params["max_depth"]]] = False
+
+    rows, token_lists = _group_tokens(row_ids[keep], tokens.filter(keep))
+    return positions[rows], token_lists
+
+
+def _explode_tokens(token_lists):
+    # One entry per token plus the position of the row it belongs to
+    token_lists = _to_arrow(token_lists)
+    row_ids = pc.list_parent_indices(token_lists).to_numpy()
+    return row_ids, pc.list_flatten(token_lists)
+
+
+def _group_tokens(row_ids, tokens):
+    # Inverse of _explode_tokens for sorted row ids, empty rows are dropped
+    rows, starts = np.unique(row_ids, return_index=True)
+    offsets = np.append(starts, row_ids.size).astype(np.int32)
+    return rows, pa.ListArray.from_arrays(pa.array(offsets), tokens)
+
+
+def _token_series(token_lists, index):
+    # Object column like the one read back from the parquet parts
+    return pd.Series(token_lists.to_pandas().to_numpy(), index=index, dtype=object)
+
+
+def tokenize_partition(df, **token_params):
+    start_time = time.perf_counter()
+    rows_in = len(df)
+    positions, token_lists = tokenize_url_paths(df["url_path"], **token_params)
+
+    df = df.iloc[positions].copy()
+    df["url_path"] = _token_series(token_lists, df.index)
+
+    # Rows left after each stage, the status filter is applied while reading
+    metrics.count("preprocess_rows", rows_in, stage="status_filter")
+    metrics.count("preprocess_rows", len(df), stage="tokenize")
+    metrics.observe(
+        "preprocess_partition", time.perf_counter() - start_time, stage="tokenize"
+    )
+    return df
+
+
+def domain_token_pairs(df):
+    row_ids, tokens = _explode_tokens(df["url_path"])
+    domains = df["url_host_registered_domain"].to_numpy(dtype=object)[row_ids]
+
+    # Rows without a domain are left out, like groupby does in the notebook
+    pairs = pd.DataFrame(
+        {"domain": domains, "token": tokens.to_numpy(zero_copy_only=False)},
+        dtype=object,
+    )
+    return pairs.dropna(subset=["domain"]).drop_duplicates(ignore_index=True)
+
+
+def filter_partition_by_min_domains(df, frequent_tokens):
+    start_time = time.perf_counter()
+    row_ids, tokens = _explode_tokens(df["url_path"])
+    keep = pc.is_in(
+        tokens, value_set=pa.array(frequent_tokens, type=tokens.type)
+    ).to_numpy(zero_copy_only=False)
+
+    rows, token_lists = _group_tokens(row_ids[keep], tokens.filter(keep))
+    df = df.iloc[rows].copy()
+    df["url_path"] = _token_series(token_lists, df.index)
+
+    metrics.count("preprocess_rows", len(df), stage="min_domains")
+    metrics.observe(
+        "preprocess_partition", time.perf_counter() - start_time, stage="min_domains"
+    )
+    return df
+
+
+def _save_json(data, path):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _load_json(path, default):
+    if not path.exists():
+        return default
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        raise Exception(f"Preprocess file ({path}) is malformed: {e}")
+
+
+def _partition_files(partitions_path, file_ids):
+    # Every file id is a directory of parquet files written by dask
+    return [
+        str(f)
+        for file_id in file_ids
+        for f in sorted((partitions_path / file_id).glob("*.parquet"))
+    ]
 
 
 class PreprocessData:
-    def __init__(self, output_data_path, dataset_data_path):
+    def __init__(
+        self,
+        output_data_path,
+        dataset_data_path,
+        partition_size="128MB",
+        token_params=None,
+        min_domains=10,
+    ):
         self._ouput_data_path = output_data_path
         self._dataset_data_path = dataset_data_path
+        self._partition_size = partition_size
+        self._token_params = {**DEFAULT_TOKEN_PARAMS, **(token_params or {})}
+        self._min_domains = min_domains
         self.dataset = None
 
     def read_dataset(self, dataset_dir_name):
-        self.dataset = dd.read_parquet()
+        dataset_path = self._dataset_data_path / dataset_dir_name
+
+        if not dataset_path.exists():
+            raise Exception(f"Dataset does not exist ({dataset_dir_name})")
+
+        dataset_files = sorted(str(f) for f in dataset_path.glob("*.parquet"))
+        if not dataset_files:
+            raise Exception(f"Dataset has no files ({dataset_dir_name})")
+
+        self.dataset = self._read_raw_files(dataset_files)
+        return self.dataset
+
+    def _read_raw_files(self, raw_files):
+        # Lazy read of the needed columns, row groups without any status
+        # other than 404 are skipped and the rest are filtered row by row
+        return dd.read_parquet(
+            raw_files,
+            columns=DATASET_COLUMNS,
+            filters=DATASET_FILTERS,
+            split_row_groups="adaptive",
+            blocksize=self._partition_size,
+        )
+
+    def tokenize(self):
+        if self.dataset is None:
+            raise Exception("No dataset loaded, call read_dataset first")
+
+        # url_path becomes a list of tokens, each partition on its own
+        meta = self.dataset._meta.assign(url_path=pd.Series([], dtype=object))
+        self.dataset = self.dataset.map_partitions(
+            tokenize_partition, meta=meta, **self._token_params
+        )
+
+        return self.dataset
+
+    def token_domain_counts(self):
+        if self.dataset is None:
+            raise Exception("No dataset loaded, call read_dataset first")
+
+        return self._count_pairs(self._domain_token_pairs(self.dataset))
+
+    def _domain_token_pairs(self, dataset):
+        # Map: distinct (domain, token) pairs per partition
+        meta = pd.DataFrame(
+            {
+                "domain": pd.Series([], dtype=object),
+                "token": pd.Series([], dtype=object),
+            }
+        )
+        return dataset.map_partitions(domain_token_pairs, meta=meta)
+
+    def _count_pairs(self, pairs):
+        # Reduce: pairs seen in several partitions are merged before counting,
+        # the shuffle keeps them out of a single worker's memory
+        pairs = pairs.drop_duplicates(split_out=True)
+        return pairs["token"].value_counts().compute()
+
+    def filter_by_min_domains(self, token_domain_counts=None):
+        if self.dataset is None:
+            raise Exception("No dataset loaded, call read_dataset first")
+
+        if token_domain_counts is None:
+            token_domain_counts = self.token_domain_counts()
+
+        frequent_tokens = token_domain_counts.index[
+            token_domain_counts >= self._min_domains
+        ]
+
+        # Second pass, each partition only needs the set of frequent tokens
+        self.dataset = self.dataset.map_partitions(
+            filter_partition_by_min_domains,
+            frequent_tokens,
+            meta=self.dataset._meta,
+        )
+
+        return self.dataset
+
+    def build_vocabulary(self, token_domain_counts):
+        # Same tokens as the ones kept by filter_by_min_domains
+        return Vocabulary.from_counts(token_domain_counts, self._min_domains)
+
+    def encode(self, vocabulary, output_dir):
+        if self.dataset is None:
+            raise Exception("No dataset loaded, call read_dataset first")
+
+        # One partition in memory at a time
+        with EncodedPathsWriter(output_dir, vocabulary) as writer:
+            for i in range(self.dataset.npartitions):
+                partition = self.dataset.get_partition(i).compute()
+                writer.append(partition["url_path"])
+
+    def _params_hash(self):
+        # Everything that changes the per-file output of preprocess()
+        params = {
+            "format": PREPROCESS_FORMAT,
+            "columns": DATASET_COLUMNS,
+            "filters": DATASET_FILTERS,
+            "token_params": self._token_params,
+        }
+        params_json = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(params_json.encode()).hexdigest()[:16]
+
+    def _preprocess_file(self, raw_file, output_path):
+        file_id = raw_file.stem
+        part_path = output_path / "parts" / file_id
+        pairs_path = output_path / "pairs" / file_id
+        shutil.rmtree(part_path, ignore_errors=True)
+        shutil.rmtree(pairs_path, ignore_errors=True)
+
+        metrics.count(
+            "preprocess_rows", pq.read_metadata(raw_file).num_rows, stage="raw"
+        )
+        dataset = self.dataset = self._read_raw_files([str(raw_file)])
+        dataset = self.tokenize()
+
+        # Local stages only, global statistics come from the pair summaries
+        # Object columns need an explicit schema, dask cannot infer it
+        status_type = pa.Schema.from_pandas(
+            dataset._meta[["fetch_status"]], preserve_index=False
+        ).field("fetch_status")
+        part_schema = pa.schema(
+            [
+                ("url_host_registered_domain", pa.string()),
+                ("url_path", pa.list_(pa.string())),
+                status_type,
+            ]
+        )
+        pairs_schema = pa.schema([("domain", pa.string()), ("token", pa.string())])
+
+        dataset.to_parquet(part_path, write_index=False, schema=part_schema)
+        self._domain_token_pairs(dd.read_parquet(part_path)).to_parquet(
+            pairs_path, write_index=False, schema=pairs_schema
+        )
+
+        return sum(pq.read_metadata(f).num_rows for f in part_path.glob("*.parquet"))
 
-    def preprocess(self, dataset_dir_name):
+    def preprocess(self, dataset_dir_name, progress=None):
+        dataset_path = self._dataset_data_path / dataset_dir_name
+        output_path = self._ouput_data_path / dataset_dir_name
+        manifest_path = output_path / "manifest.json"
 
-        pass
+        if not dataset_path.exists():
+            raise Exception(f"Dataset does not exist ({dataset_dir_name})")
+
+        raw_files = {f.stem: f for f in dataset_path.glob("*.parquet")}
+        if not raw_files:
+            raise Exception(f"Dataset has no files ({dataset_dir_name})")
+
+        output_path.mkdir(parents=True, exist_ok=True)
+        manifest = _load_json(manifest_path, {"files": {}})
+        params_hash = self._params_hash()
+
+        # Parts of files that left the dataset are dropped
+        removed = [file_id for file_id in manifest["files"] if file_id not in raw_files]
+        if removed:
+            self._invalidate_merge(manifest, manifest_path)
+        for file_id in removed:
+            shutil.rmtree(output_path / "parts" / file_id, ignore_errors=True)
+            shutil.rmtree(output_path / "pairs" / file_id, ignore_errors=True)
+            manifest["files"].pop(file_id)
+
+        # Only new files, changed files or files done with other params
+        pending = []
+        for file_id, raw_file in raw_files.items():
+            raw_stat = raw_file.stat()
+            file_details = manifest["files"].get(file_id)
+            if (
+                file_details is None
+                or file_details["params_hash"] != params_hash
+                or file_details["size"] != raw_stat.st_size
+                or file_details["mtime"] != raw_stat.st_mtime_ns
+            ):
+                pending.append((file_id, raw_file, raw_stat))
+
+        # Until the merge succeeds, a rerun merges even with nothing pending
+        if pending:
+            self._invalidate_merge(manifest, manifest_path)
+
+        task = None
+        if progress is not None:
+            task = progress.add_task("Preprocessing", total=len(pending))
+
+        for file_id, raw_file, raw_stat in pending:
+            with metrics.timer("preprocess_file"):
+                rows = self._preprocess_file(raw_file, output_path)
+            manifest["files"][file_id] = {
+                "params_hash": params_hash,
+                "size": raw_stat.st_size,
+                "mtime": raw_stat.st_mtime_ns,
+                "rows": rows,
+            }
+
+            # Saved per file so an interrupted run keeps the finished ones
+            _save_json(manifest, manifest_path)
+            if task is not None:
+                progress.update(task, advance=1)
+
+        # Global stages are merged from the per-file summaries
+        is_stale = (
+            pending
+            or removed
+            or manifest.get("min_domains") != self._min_domains
+            or manifest.get("vocabulary_version") is None
+        )
+        if is_stale:
+            self._invalidate_merge(manifest, manifest_path)
+            with metrics.timer("preprocess_merge"):
+                self._merge_global(output_path, manifest)
+            _save_json(manifest, manifest_path)
+
+        self._update_index(dataset_dir_name, manifest)
+        return {"processed": [file_id for file_id, _, _ in pending], "removed": removed}
+
+    def _invalidate_merge(self, manifest, manifest_path):
+        if manifest.get("vocabulary_version") is None:
+            return
+
+        manifest["vocabulary_version"] = None
+        _save_json(manifest, manifest_path)
+
+    def _merge_global(self, output_path, manifest):
+        file_ids = sorted(manifest["files"])
+
+        pairs = dd.read_parquet(_partition_files(output_path / "pairs", file_ids))
+        token_domain_counts = self._count_pairs(pairs)
+        token_domain_counts.rename("count").to_frame().to_parquet(
+            output_path / "token_domain_counts.parquet"
+        )
+
+        vocabulary = self.build_vocabulary(token_domain_counts)
+
+        self.dataset = dd.read_parquet(
+            _partition_files(output_path / "parts", file_ids)
+        )
+        self.filter_by_min_domains(token_domain_counts)
+        self.encode(vocabulary, output_path / "encoded")
+
+        # Written after the encoded paths, a new vocabulary never pairs with
+        # old paths. The manifest version, saved by the caller, comes last
+        vocabulary.save(output_path / "vocab.json")
+
+        manifest["min_domains"] = self._min_domains
+        manifest["vocabulary_version"] = vocabulary.version
+        manifest["vocabulary_size"] = len(vocabulary)
+
+    def _update_index(self, dataset_dir_name, manifest=None):
+        # Summary of every preprocessed dataset, all list() has to read
+        index_path = self._ouput_data_path / "index.json"
+        index = _load_json(index_path, {})
+
+        if manifest is None:
+            index.pop(dataset_dir_name, None)
+        else:
+            index[dataset_dir_name] = {
+                "files": len(manifest["files"]),
+                "rows": sum(f["rows"] for f in manifest["files"].values()),
+                "min_domains": manifest["min_domains"],
+                "vocabulary_version": manifest["vocabulary_version"],
+                "vocabulary_size": manifest["vocabulary_size"],
+            }
+
+        _save_json(index, index_path)
 
     def list(self):
-        pass
+        return _load_json(self._ouput_data_path / "index.json", {})
+
+    def load(self, dataset_dir_name):
+        # Filtered dataset, vocabulary and encoded paths for training
+        output_path = self._ouput_data_path / dataset_dir_name
+        manifest = _load_json(output_path / "manifest.json", {})
+        if manifest.get("vocabulary_version") is None:
+            raise Exception(f"Dataset ({dataset_dir_name}) is not preprocessed")
+
+        vocabulary = Vocabulary.load(output_path / "vocab.json")
+        encoded_paths = EncodedPaths(output_path / "encoded", vocabulary)
+
+        self.dataset = dd.read_parquet(
+            _partition_files(output_path / "parts", sorted(manifest["files"]))
+        )
+        token_domain_counts = pd.read_parquet(
+            output_path / "token_domain_counts.parquet"
+        )["count"]
+        self.filter_by_min_domains(token_domain_counts)
+
+        return self.dataset, vocabulary, encoded_paths
 
     def delete(self, dataset_dir_name):
-        pass
+        output_path = self._ouput_data_path / dataset_dir_name
+        if not output_path.exists():
+            return False
+
+        shutil.rmtree(output_path)
+        self._update_index(dataset_dir_name)
+        return True
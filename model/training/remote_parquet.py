@@ -0,0 +1,103 @@
+import io
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Bytes fetched from the end of the file, the footer of most files fits
+FOOTER_READ_SIZE = 64 * 1024
+
+# Schema metadata key of the files written by write_projection
+PROJECTION_KEY = b"goneuro.projection"
+
+
+class RangeReader(io.RawIOBase):
+    """Read-only file over a remote object, every read is one range request.
+
+    fetch_range(start, end) returns the bytes start to end - 1. The tail
+    already fetched with the size is served from memory, pyarrow reads the
+    footer from it.
+    """
+
+    def __init__(self, fetch_range, size, tail=b""):
+        self._fetch_range = fetch_range
+        self._size = size
+        self._tail_start = size - len(tail)
+        self._tail = tail
+        self._position = 0
+        self.fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        match whence:
+            case io.SEEK_SET:
+                self._position = offset
+            case io.SEEK_CUR:
+                self._position += offset
+            case io.SEEK_END:
+                self._position = self._size + offset
+
+        return self._position
+
+    def read(self, size=-1):
+        start = self._position
+        end = self._size if size < 0 else min(self._size, start + size)
+        if start >= end:
+            return b""
+
+        if start >= self._tail_start:
+            data = self._tail[start - self._tail_start : end - self._tail_start]
+        else:
+            data = self._fetch_range(start, end)
+            self.fetched += len(data)
+
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def write_projection(source, columns, dest_path, on_row_group=None):
+    # Column chunks of nearby columns are fetched together by pre_buffer
+    parquet_file = pq.ParquetFile(source, pre_buffer=True)
+    schema = parquet_file.schema_arrow
+
+    missing = [column for column in columns if column not in schema.names]
+    if missing:
+        raise Exception(f"Columns missing from the remote file ({', '.join(missing)})")
+
+    projection = {"columns": list(columns)}
+    projected_schema = pa.schema(
+        [schema.field(column) for column in columns],
+        metadata={PROJECTION_KEY: json.dumps(projection).encode()},
+    )
+
+    # Same row groups as the source, their statistics still skip 404 groups
+    with pq.ParquetWriter(dest_path, projected_schema, compression="zstd") as writer:
+        for i in range(parquet_file.num_row_groups):
+            row_group = parquet_file.read_row_group(i, columns=columns)
+            writer.write_table(row_group.cast(projected_schema))
+            if on_row_group is not None:
+                on_row_group(i + 1, parquet_file.num_row_groups)
+
+    return parquet_file.num_row_groups
+
+
+def projected_columns(file_path):
+    # Columns kept by write_projection, None for a complete file
+    metadata = pq.read_schema(file_path).metadata or {}
+    if PROJECTION_KEY not in metadata:
+        return None
+
+    return json.loads(metadata[PROJECTION_KEY])["columns"]
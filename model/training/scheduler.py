@@ -0,0 +1,176 @@
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+# Statuses the server uses to ask for fewer requests
+THROTTLE_STATUSES = (429, 503)
+# Statuses worth another attempt after a backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value, max_seconds=300):
+    # Either a number of seconds or an HTTP date
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return min(float(value), max_seconds)
+
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return min(max(0.0, retry_date.timestamp() - time.time()), max_seconds)
+
+
+class RetryableStatus(Exception):
+    def __init__(self, url, status, retry_after=None):
+        super().__init__(f"Server answered {status} ({url})")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class FetchScheduler:
+    """AIMD limit on the requests in flight, shared by the download threads.
+
+    Each success while the limit is reached adds 1/limit, about one more
+    request per round. A throttled request cuts the limit by decrease_factor,
+    once for all the requests already in flight, and its Retry-After pauses
+    every new request. max_bytes_per_sec caps all the downloads together,
+    0 is no cap.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=10,
+        initial_concurrency=4,
+        min_concurrency=1,
+        decrease_factor=0.5,
+        max_bytes_per_sec=0,
+        backoff_factor=0.5,
+        max_backoff=60,
+        bandwidth_window=5,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self._min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self._limit = float(
+            min(max(initial_concurrency, self._min_concurrency), self.max_concurrency)
+        )
+        self._decrease_factor = decrease_factor
+        self._backoff_factor = backoff_factor
+        self._max_backoff = max_backoff
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+
+        # Token bucket of the bandwidth cap, negative while paying back a burst
+        self._bytes_lock = threading.Lock()
+        self._max_bytes_per_sec = max_bytes_per_sec
+        self._tokens = float(max_bytes_per_sec)
+        self._tokens_time = time.monotonic()
+
+        # Bytes received in the last bandwidth_window seconds
+        self._bandwidth_window = bandwidth_window
+        self._recent = deque()
+        self._recent_bytes = 0
+        self._first_bytes_time = None
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    self._cond.wait(self._paused_until - now)
+                elif self._in_flight >= int(self._limit):
+                    self._cond.wait()
+                else:
+                    break
+            self._in_flight += 1
+
+        started = time.monotonic()
+        try:
+            yield started
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            # Only grow while the limit is what holds requests back
+            if self._in_flight >= int(self._limit):
+                self._limit = min(self.max_concurrency, self._limit + 1 / self._limit)
+                self._cond.notify_all()
+
+    def on_throttle(self, started, retry_after=None):
+        with self._cond:
+            now = time.monotonic()
+
+            # Requests sent before the last cut are part of the same burst
+            if started >= self._last_decrease:
+                self._limit = max(
+                    self._min_concurrency, self._limit * self._decrease_factor
+                )
+                self._last_decrease = now
+
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+    def backoff(self, attempt):
+        # Full jitter, retries of many threads do not arrive together
+        return random.uniform(
+            0, min(self._max_backoff, self._backoff_factor * 2**attempt)
+        )
+
+    def consume(self, size):
+        wait = 0.0
+        with self._bytes_lock:
+            now = time.monotonic()
+            if self._first_bytes_time is None:
+                self._first_bytes_time = now
+
+            self._recent.append((now, size))
+            self._recent_bytes += size
+            self._prune(now)
+
+            if self._max_bytes_per_sec:
+                cap = self._max_bytes_per_sec
+                self._tokens = min(cap, self._tokens + (now - self._tokens_time) * cap)
+                self._tokens_time = now
+                self._tokens -= size
+                if self._tokens < 0:
+                    wait = -self._tokens / cap
+
+        if wait:
+            time.sleep(wait)
+
+    def _prune(self, now):
+        while self._recent and self._recent[0][0] < now - self._bandwidth_window:
+            self._recent_bytes -= self._recent.popleft()[1]
+
+    def stats(self):
+        with self._cond:
+            concurrency = int(self._limit)
+            in_flight = self._in_flight
+
+        with self._bytes_lock:
+            now = time.monotonic()
+            self._prune(now)
+            span = 0.0
+            if self._first_bytes_time is not None:
+                span = min(self._bandwidth_window, now - self._first_bytes_time)
+            bytes_per_sec = self._recent_bytes / span if span > 0 else 0.0
+
+        return {
+            "concurrency": concurrency,
+            "in_flight": in_flight,
+            "bytes_per_sec": bytes_per_sec,
+        }
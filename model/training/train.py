@@ -0,0 +1,478 @@
+import dask
+import multiprocessing
+import numpy as np
+import re
+import time
+from collections import deque
+from functools import lru_cache
+import pandas as pd
+from scipy import sparse
+
+from model.training.vocabulary import EncodedPaths
+from model.utils.metrics import metrics
+
+
+def site_dir_pairs(df, vocabulary):
+    # Top-level directory of every path as a vocabulary index
+    first_tokens = df["url_path"].str[0].to_numpy(dtype=object)
+    pairs = pd.DataFrame(
+        {
+            "domain": df["url_host_registered_domain"].to_numpy(dtype=object),
+            "dir": vocabulary.encode(first_tokens),
+        }
+    )
+
+    pairs = pairs[(pairs["dir"] != -1) & pairs["domain"].notna()]
+    return pairs.drop_duplicates(ignore_index=True)
+
+
+def chunk_cooccurrence(pairs, n_dirs):
+    # Every domain of the chunk must be complete, see LateralModel.build
+    pairs = pairs.drop_duplicates()
+    sites, domains = pd.factorize(pairs["domain"])
+
+    # Site x directory incidence matrix, X.T @ X counts the sites of each pair
+    incidence = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.int32), (sites, pairs["dir"].to_numpy())),
+        shape=(len(domains), n_dirs),
+    )
+    cooccur = (incidence.T @ incidence).tocsr()
+
+    # The diagonal is the number of sites with the directory
+    dir_counts = cooccur.diagonal().astype(np.int64)
+    cooccur.setdiag(0)
+    cooccur.eliminate_zeros()
+
+    return cooccur, dir_counts
+
+
+def _merge_cooccurrence(*results):
+    cooccur = results[0][0].copy()
+    dir_counts = results[0][1].copy()
+    for chunk_cooccur, chunk_dir_counts in results[1:]:
+        cooccur += chunk_cooccur
+        dir_counts += chunk_dir_counts
+
+    return cooccur, dir_counts
+
+
+def top_neighbors(cooccur, k):
+    # Rows sorted by count (ties by directory index) and cut to k entries,
+    # data stays in rank order so a shorter list is just a prefix
+    row_lengths = np.diff(cooccur.indptr)
+    rows = np.repeat(np.arange(cooccur.shape[0]), row_lengths)
+    order = np.lexsort((cooccur.indices, -cooccur.data, rows))
+    ranks = np.arange(order.size) - cooccur.indptr[rows]
+    keep = order[ranks < k]
+
+    indptr = np.zeros(cooccur.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.minimum(row_lengths, k), out=indptr[1:])
+    neighbors = sparse.csr_matrix(
+        (cooccur.data[keep].astype(np.int64), cooccur.indices[keep], indptr),
+        shape=cooccur.shape,
+    )
+    neighbors.has_sorted_indices = False
+    return neighbors
+
+
+class LateralModel:
+    def __init__(self, cooccur, dir_counts, vocabulary, neighbors=None, neighbor_k=200):
+        self.cooccur = cooccur
+        self.dir_counts = dir_counts
+        self.vocabulary = vocabulary
+        self.neighbor_k = neighbor_k
+
+        # Top neighbors of every directory, computed once for all queries
+        if neighbors is None:
+            neighbors = top_neighbors(cooccur, neighbor_k)
+        self.neighbors = neighbors
+
+    @classmethod
+    def build(cls, dataset, vocabulary, merge_width=8, neighbor_k=200):
+        meta = pd.DataFrame(
+            {"domain": pd.Series([], dtype=object), "dir": pd.Series([], dtype="int32")}
+        )
+        pairs = dataset.map_partitions(site_dir_pairs, vocabulary, meta=meta)
+
+        # Send each domain to a single partition so chunks can be built alone
+        pairs = pairs.shuffle(on="domain")
+
+        # Chunks are built in parallel and merged as a tree
+        results = [
+            dask.delayed(chunk_cooccurrence)(chunk, len(vocabulary))
+            for chunk in pairs.to_delayed()
+        ]
+        while len(results) > 1:
+            results = [
+                dask.delayed(_merge_cooccurrence)(*results[i : i + merge_width])
+                for i in range(0, len(results), merge_width)
+            ]
+
+        with metrics.timer("train_lateral_build"):
+            cooccur, dir_counts = dask.compute(results[0])[0]
+        return cls(cooccur, dir_counts, vocabulary, neighbor_k=neighbor_k)
+
+    @classmethod
+    def load(cls, model_path, vocabulary):
+        try:
+            with np.load(model_path) as model_npz:
+                version = str(model_npz["vocabulary_version"])
+                cooccur = sparse.csr_matrix(
+                    (
+                        model_npz["data"],
+                        model_npz["indices"],
+                        model_npz["indptr"],
+                    ),
+                    shape=tuple(model_npz["shape"]),
+                )
+                dir_counts = model_npz["dir_counts"]
+                neighbor_k = int(model_npz["neighbor_k"])
+                neighbors = sparse.csr_matrix(
+                    (
+                        model_npz["neighbor_data"],
+                        model_npz["neighbor_indices"],
+                        model_npz["neighbor_indptr"],
+                    ),
+                    shape=cooccur.shape,
+                )
+                neighbors.has_sorted_indices = False
+        except Exception as e:
+            raise Exception(f"Lateral model ({model_path}) is not valid: {e}")
+
+        if version != vocabulary.version:
+            raise Exception(f"Lateral model ({model_path}) uses another vocabulary")
+
+        return cls(cooccur, dir_counts, vocabulary, neighbors, neighbor_k)
+
+    def save(self, model_path):
+        np.savez_compressed(
+            model_path,
+            data=self.cooccur.data,
+            indices=self.cooccur.indices,
+            indptr=self.cooccur.indptr,
+            shape=np.array(self.cooccur.shape),
+            dir_counts=self.dir_counts,
+            neighbor_data=self.neighbors.data,
+            neighbor_indices=self.neighbors.indices,
+            neighbor_indptr=self.neighbors.indptr,
+            neighbor_k=np.array(self.neighbor_k),
+            vocabulary_version=np.array(self.vocabulary.version),
+        )
+
+
+class LateralRecommender:
+    def __init__(self, lateral_model, cache_size=4096):
+        self._model = lateral_model
+        self._vocabulary = lateral_model.vocabulary
+        self._neighbor_matrices = {}
+
+        # Repeated input sets are answered from memory
+        self._recommend_cached = lru_cache(maxsize=cache_size)(self._recommend_set)
+
+        neighbors = lateral_model.neighbors
+        self._neighbor_ranks = np.arange(neighbors.nnz) - np.repeat(
+            neighbors.indptr[:-1], np.diff(neighbors.indptr)
+        )
+
+    def _neighbor_matrix(self, limit):
+        # Neighbor lists cut to the first limit entries of every row
+        if limit in self._neighbor_matrices:
+            return self._neighbor_matrices[limit]
+
+        # Longer than the lists kept by the model, ranked again from the
+        # co-occurrence counts so a large top_k still matches the notebook
+        if limit > self._model.neighbor_k:
+            self._neighbor_matrices[limit] = top_neighbors(self._model.cooccur, limit)
+        else:
+            neighbors = self._model.neighbors
+            keep = self._neighbor_ranks < limit
+            row_lengths = np.bincount(
+                np.repeat(np.arange(neighbors.shape[0]), np.diff(neighbors.indptr))[
+                    keep
+                ],
+                minlength=neighbors.shape[0],
+            )
+            indptr = np.zeros(neighbors.shape[0] + 1, dtype=np.int64)
+            np.cumsum(row_lengths, out=indptr[1:])
+            self._neighbor_matrices[limit] = sparse.csr_matrix(
+                (neighbors.data[keep], neighbors.indices[keep], indptr),
+                shape=neighbors.shape,
+            )
+
+        return self._neighbor_matrices[limit]
+
+    def _recommend_set(self, input_dirs, top_k):
+        return tuple(self.recommend_batch([input_dirs], top_k)[0])
+
+    def recommend(self, input_dirs, top_k=100):
+        return list(self._recommend_cached(frozenset(input_dirs), top_k))
+
+    def recommend_batch(self, input_dir_sets, top_k=100):
+        # Like the notebook, each input directory adds its top_k * 2 neighbors
+        neighbors = self._neighbor_matrix(top_k * 2)
+        n_dirs = neighbors.shape[0]
+
+        query_rows, query_dirs = [], []
+        for i, input_dirs in enumerate(input_dir_sets):
+            dir_idx = {self._vocabulary.token_to_idx.get(d) for d in input_dirs}
+            dir_idx.discard(None)
+            query_rows.extend([i] * len(dir_idx))
+            query_dirs.extend(dir_idx)
+
+        queries = sparse.csr_matrix(
+            (np.ones(len(query_rows), dtype=np.int64), (query_rows, query_dirs)),
+            shape=(len(input_dir_sets), n_dirs),
+        )
+
+        # One product scores the whole batch, input dirs are then removed
+        scores = (queries @ neighbors).tocsr()
+        scores = (scores - scores.multiply(queries)).tocsr()
+        scores.eliminate_zeros()
+
+        recommendations = []
+        for i in range(len(input_dir_sets)):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            row_scores = scores.data[start:end]
+            row_dirs = scores.indices[start:end]
+
+            # Every tie of the top_k-th score is kept, the lexsort cut then
+            # breaks ties by vocabulary index
+            if row_scores.size > top_k:
+                kth_score = -np.partition(-row_scores, top_k - 1)[top_k - 1]
+                best = row_scores >= kth_score
+                row_scores, row_dirs = row_scores[best], row_dirs[best]
+
+            order = np.lexsort((row_dirs, -row_scores))[:top_k]
+            recommendations.append(
+                [
+                    (self._vocabulary.idx_to_token[d], int(score))
+                    for d, score in zip(row_dirs[order], row_scores[order])
+                ]
+            )
+
+        return recommendations
+
+
+def numeric_token_weights(vocabulary, numeric_weight=0.1):
+    # Lower weight for targets made only of digits, as in the notebook
+    weights = np.ones(len(vocabulary), dtype=np.float32)
+    for idx, token in enumerate(vocabulary.idx_to_token[1:], start=1):
+        if re.fullmatch(r"\d+", token):
+            weights[idx] = numeric_weight
+
+    return weights
+
+
+def prefix_target_pairs(tokens, offsets, start, end, max_len, seed=None):
+    """Every (prefix, next token) pair of the paths start to end - 1.
+
+    Prefixes are padded and truncated at the front like
+    pad_sequences(padding="pre"). Pairs are shuffled if a seed is given.
+    """
+    path_starts = np.asarray(offsets[start : end + 1], dtype=np.int64)
+    lengths = np.diff(path_starts)
+    n_pairs = np.maximum(lengths - 1, 0)
+
+    # Position of the target inside its path, from 1 to length - 1
+    pair_paths = np.repeat(np.arange(lengths.size), n_pairs)
+    pair_starts = np.cumsum(n_pairs) - n_pairs
+    positions = np.arange(pair_paths.size) - pair_starts[pair_paths] + 1
+
+    if seed is not None:
+        order = np.random.default_rng(seed).permutation(pair_paths.size)
+        pair_paths, positions = pair_paths[order], positions[order]
+
+    # Only the slice of the memory-mapped buffer for these paths is read
+    chunk_tokens = np.asarray(tokens[path_starts[0] : path_starts[-1]])
+    bases = path_starts[pair_paths] - path_starts[0]
+
+    y = chunk_tokens[bases + positions]
+    prefix_idx = positions[:, None] - max_len + np.arange(max_len)[None, :]
+    X = np.where(
+        prefix_idx >= 0,
+        chunk_tokens[bases[:, None] + np.maximum(prefix_idx, 0)],
+        0,
+    ).astype(np.int32)
+
+    return X, y
+
+
+def _chunk_pairs_worker(args):
+    encoded_dir, start, end, max_len, seed = args
+    encoded_paths = EncodedPaths(encoded_dir)
+    return prefix_target_pairs(
+        encoded_paths.tokens, encoded_paths.offsets, start, end, max_len, seed
+    )
+
+
+class PrefixBatchGenerator:
+    def __init__(
+        self,
+        encoded_paths,
+        batch_size=32,
+        max_len=None,
+        chunk_size=4096,
+        shuffle=True,
+        seed=0,
+        shard=0,
+        num_shards=1,
+        workers=0,
+        token_weights=None,
+    ):
+        self._encoded_paths = encoded_paths
+        self.batch_size = batch_size
+        self._chunk_size = chunk_size
+        self._shuffle = shuffle
+        self._seed = seed
+        self._workers = workers
+        self._token_weights = token_weights
+
+        # Chunks of paths are dealt round-robin to the shards
+        chunks = [
+            (start, min(start + chunk_size, len(encoded_paths)))
+            for start in range(0, len(encoded_paths), chunk_size)
+        ]
+        self._chunks = chunks[shard::num_shards]
+
+        # Path lengths one chunk at a time, memory does not grow with the
+        # dataset. The longest prefix of every shard, like the notebook's
+        # max_len, and the pairs of this shard
+        longest, self.pairs = 0, 0
+        offsets = encoded_paths.offsets
+        for i, (start, end) in enumerate(chunks):
+            lengths = np.diff(offsets[start : end + 1])
+            longest = max(longest, int(lengths.max(initial=0)))
+            if i % num_shards == shard:
+                self.pairs += int(np.maximum(lengths - 1, 0).sum())
+
+        if max_len is None:
+            max_len = max(longest - 1, 1)
+        self.max_len = max_len
+
+    def __len__(self):
+        # Batches per epoch
+        return -(-self.pairs // self.batch_size)
+
+    def __iter__(self):
+        # Endless stream of epochs, for model.fit with steps_per_epoch
+        epoch = 0
+        while True:
+            yield from self.epoch(epoch)
+            epoch += 1
+
+    def _chunk_tasks(self, epoch):
+        chunks = list(self._chunks)
+        rng = np.random.default_rng([self._seed, epoch])
+        if self._shuffle:
+            rng.shuffle(chunks)
+
+        for start, end in chunks:
+            chunk_seed = int(rng.integers(2**32)) if self._shuffle else None
+            yield (
+                self._encoded_paths.encoded_dir,
+                start,
+                end,
+                self.max_len,
+                chunk_seed,
+            )
+
+    def _chunk_pairs(self, epoch):
+        tasks = self._chunk_tasks(epoch)
+
+        if not self._workers:
+            for task in tasks:
+                encoded_dir, start, end, max_len, seed = task
+                start_time = time.perf_counter()
+                pairs = prefix_target_pairs(
+                    self._encoded_paths.tokens,
+                    self._encoded_paths.offsets,
+                    start,
+                    end,
+                    max_len,
+                    seed,
+                )
+                metrics.observe(
+                    "train_chunk", time.perf_counter() - start_time, stage="build"
+                )
+                yield pairs
+            return
+
+        # A bounded number of chunks in flight keeps memory constant
+        with multiprocessing.Pool(self._workers) as pool:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.apply_async(_chunk_pairs_worker, (task,)))
+                if len(pending) > self._workers * 2:
+                    yield self._wait_chunk(pending.popleft())
+            while pending:
+                yield self._wait_chunk(pending.popleft())
+
+    def _wait_chunk(self, result):
+        # Time the training loop is blocked on the workers
+        with metrics.timer("train_chunk", stage="wait"):
+            return result.get()
+
+    def epoch(self, epoch=0):
+        carry_X = np.zeros((0, self.max_len), dtype=np.int32)
+        carry_y = np.zeros(0, dtype=np.int32)
+
+        for X, y in self._chunk_pairs(epoch):
+            # Pairs left from the previous chunk fill the first batch
+            X = np.concatenate([carry_X, X])
+            y = np.concatenate([carry_y, y])
+
+            full = (y.size // self.batch_size) * self.batch_size
+            for i in range(0, full, self.batch_size):
+                yield self._batch(
+                    X[i : i + self.batch_size], y[i : i + self.batch_size]
+                )
+            carry_X, carry_y = X[full:], y[full:]
+
+        if carry_y.size:
+            yield self._batch(carry_X, carry_y)
+
+    def _batch(self, X, y):
+        if self._token_weights is None:
+            return X, y
+
+        return X, y, self._token_weights[y]
+
+
+def train_hierarchical(
+    encoded_paths,
+    vocabulary,
+    model_path,
+    mode="full",
+    epochs=20,
+    batch_size=32,
+    num_sampled=64,
+    workers=0,
+    eval_steps=None,
+    callback=None,
+):
+    # TensorFlow is heavy to import, only loaded when this model is trained
+    from model.training.hierarchical import (
+        HierarchicalTrainer,
+        build_hierarchical_model,
+    )
+
+    batch_generator = PrefixBatchGenerator(
+        encoded_paths,
+        batch_size=batch_size,
+        workers=workers,
+        token_weights=numeric_token_weights(vocabulary),
+    )
+    if len(batch_generator) == 0:
+        raise Exception(
+            f"No training data (no prefix pairs in {encoded_paths.encoded_dir})"
+        )
+
+    model = build_hierarchical_model(len(vocabulary), batch_generator.max_len)
+
+    # Sampled softmax only while training, evaluation uses the full softmax
+    trainer = HierarchicalTrainer(model, mode, num_sampled)
+    history = trainer.train(batch_generator, epochs, callback=callback)
+    evaluation = trainer.evaluate(batch_generator, eval_steps)
+
+    model.save(model_path)
+    return {"history": history, "evaluation": evaluation}
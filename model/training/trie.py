@@ -0,0 +1,208 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from model.training.formats import TRIE_FORMAT
+
+# Flat arrays of the trie, one .npy file each so they can be memory-mapped
+TRIE_ARRAYS = [
+    "node_token",
+    "node_count",
+    "child_total",
+    "child_indptr",
+    "sorted_tokens",
+    "sorted_children",
+]
+
+
+class PathTrie:
+    """Prefix trie of the encoded paths stored in flat arrays.
+
+    Node 0 is the root. Nodes are numbered level by level, so the children
+    of node p are the nodes child_indptr[p] to child_indptr[p + 1] - 1,
+    already ranked by count. The same range of sorted_tokens and
+    sorted_children holds them ordered by token for binary search.
+    """
+
+    def __init__(self, arrays, vocabulary_version, max_depth=None):
+        for name in TRIE_ARRAYS:
+            setattr(self, name, arrays[name])
+
+        self.vocabulary_version = vocabulary_version
+        self.max_depth = max_depth
+
+    def __len__(self):
+        return len(self.node_token)
+
+    @classmethod
+    def build(cls, encoded_paths, vocabulary, max_depth=None):
+        tokens = encoded_paths.tokens
+        offsets = np.asarray(encoded_paths.offsets)
+        lengths = np.diff(offsets)
+        depth_limit = int(lengths.max(initial=0))
+        if max_depth is not None:
+            depth_limit = min(depth_limit, max_depth)
+
+        n_tokens = len(vocabulary)
+        node_parent = [np.zeros(1, dtype=np.int64)]
+        node_token = [np.zeros(1, dtype=np.int32)]
+        node_count = [np.array([len(lengths)], dtype=np.int64)]
+
+        # Node every path is at, one level is added per pass
+        path_node = np.zeros(len(lengths), dtype=np.int64)
+        active = np.arange(len(lengths))
+        next_node = 1
+
+        for depth in range(depth_limit):
+            active = active[lengths[active] > depth]
+            if not active.size:
+                break
+
+            parent = path_node[active]
+            token = np.asarray(tokens[offsets[active] + depth], dtype=np.int64)
+            keys, inverse, counts = np.unique(
+                parent * n_tokens + token, return_inverse=True, return_counts=True
+            )
+            level_parent, level_token = np.divmod(keys, n_tokens)
+
+            # Grouped by parent, most frequent child first, then by token
+            order = np.lexsort((level_token, -counts, level_parent))
+            rank = np.empty_like(order)
+            rank[order] = np.arange(order.size)
+            path_node[active] = next_node + rank[inverse]
+
+            node_parent.append(level_parent[order])
+            node_token.append(level_token[order].astype(np.int32))
+            node_count.append(counts[order])
+            next_node += order.size
+
+        node_parent = np.concatenate(node_parent)
+        node_token = np.concatenate(node_token)
+        node_count = np.concatenate(node_count)
+
+        # Parents never decrease with the node number, except for the root
+        child_indptr = np.searchsorted(
+            node_parent[1:], np.arange(next_node + 1), side="left"
+        ).astype(np.int64)
+        child_indptr += 1
+
+        sorted_children = np.zeros(next_node, dtype=np.int64)
+        sorted_children[1:] = np.lexsort((node_token[1:], node_parent[1:])) + 1
+        child_total = np.bincount(
+            node_parent[1:], weights=node_count[1:], minlength=next_node
+        ).astype(np.int64)
+
+        arrays = {
+            "node_token": node_token,
+            "node_count": node_count,
+            "child_total": child_total,
+            "child_indptr": child_indptr,
+            "sorted_tokens": node_token[sorted_children],
+            "sorted_children": sorted_children,
+        }
+        return cls(arrays, vocabulary.version, max_depth)
+
+    @classmethod
+    def load(cls, trie_path, vocabulary, mmap=True):
+        try:
+            with open(trie_path / "meta.json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except Exception as e:
+            raise Exception(f"Trie ({trie_path}) is missing: {e}")
+
+        if meta.get("format") != TRIE_FORMAT:
+            raise Exception(f"Unsupported trie format ({trie_path})")
+
+        if meta["vocabulary_version"] != vocabulary.version:
+            raise Exception(f"Trie ({trie_path}) uses another vocabulary version")
+
+        # Plain ndarray views of the mapping, memmap slicing is much slower
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.asarray(np.load(trie_path / f"{name}.npy", mmap_mode=mmap_mode))
+            for name in TRIE_ARRAYS
+        }
+        return cls(arrays, meta["vocabulary_version"], meta["max_depth"])
+
+    def save(self, trie_path):
+        # Written next to the old trie, a server may still have its arrays
+        # memmapped and overwriting them in place crashes it
+        tmp_path = trie_path.with_name(trie_path.name + ".tmp")
+        old_path = trie_path.with_name(trie_path.name + ".old")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        for name in TRIE_ARRAYS:
+            np.save(tmp_path / f"{name}.npy", getattr(self, name))
+
+        # Written last, a trie without meta.json is incomplete
+        meta = {
+            "format": TRIE_FORMAT,
+            "vocabulary_version": self.vocabulary_version,
+            "max_depth": self.max_depth,
+            "nodes": len(self),
+        }
+        with open(tmp_path / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+        # Mapped files of the old trie stay readable until they are unmapped
+        shutil.rmtree(old_path, ignore_errors=True)
+        if trie_path.exists():
+            os.replace(trie_path, old_path)
+        os.replace(tmp_path, trie_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def child(self, node, token):
+        start, end = self.child_indptr[node], self.child_indptr[node + 1]
+        i = start + self.sorted_tokens[start:end].searchsorted(token)
+        if i < end and self.sorted_tokens[i] == token:
+            return int(self.sorted_children[i])
+
+        return None
+
+    def find(self, prefix_idx):
+        node = 0
+        for token in prefix_idx:
+            node = self.child(node, token)
+            if node is None:
+                return None
+
+        return node
+
+    def top_children(self, node, top_k):
+        start = self.child_indptr[node]
+        end = min(self.child_indptr[node + 1], start + top_k)
+        return self.node_token[start:end], self.node_count[start:end]
+
+
+class TriePredictor:
+    """Frequency-ranked children, same predict API as HierarchicalPredictor."""
+
+    def __init__(self, path_trie, vocabulary):
+        if path_trie.vocabulary_version != vocabulary.version:
+            raise Exception("Trie uses another vocabulary version")
+
+        self._trie = path_trie
+        self._vocabulary = vocabulary
+
+    def predict(self, path_tokens, top_k=10):
+        idx = self._vocabulary.token_to_idx
+        prefix_idx = [idx[t] for t in (t.lower() for t in path_tokens) if t in idx]
+
+        # Unknown prefixes back off to shorter ones, down to the root
+        node = None
+        while node is None:
+            node = self._trie.find(prefix_idx)
+            prefix_idx = prefix_idx[1:]
+
+        total = self._trie.child_total[node]
+        children, counts = self._trie.top_children(node, top_k)
+        return [
+            (self._vocabulary.idx_to_token[token], float(count / total))
+            for token, count in zip(children.tolist(), counts.tolist())
+        ]
+
+    def predict_batch(self, token_lists, top_k=10):
+        return [self.predict(tokens, top_k) for tokens in token_lists]
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from model.training.formats import VOCABULARY_FORMAT
+
+# Index 0 is kept for padding, tokens start at 1
+PADDING_IDX = 0
+
+
+class Vocabulary:
+    def __init__(self, tokens):
+        self.idx_to_token = [None] + list(tokens)
+        self._token_index = pd.Index(tokens)
+        self.token_to_idx = {token: idx for idx, token in enumerate(tokens, start=1)}
+
+        # Same tokens in the same order always give the same version
+        self.version = hashlib.sha256("\n".join(tokens).encode()).hexdigest()[:16]
+
+    def __len__(self):
+        # Including padding, the input size of an embedding layer
+        return len(self.idx_to_token)
+
+    @classmethod
+    def from_counts(cls, token_counts, min_count=1):
+        # Most frequent first, ties broken by the token so order is stable
+        counts = token_counts[token_counts >= min_count]
+        ordered = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        return cls([token for token, _ in ordered])
+
+    @classmethod
+    def load(cls, vocabulary_path):
+        try:
+            with open(vocabulary_path, "r", encoding="utf-8") as f:
+                vocabulary_json = json.load(f)
+        except Exception as e:
+            raise Exception(f"Vocabulary file ({vocabulary_path}) is not valid: {e}")
+
+        if vocabulary_json.get("format") != VOCABULARY_FORMAT:
+            raise Exception(f"Unsupported vocabulary format ({vocabulary_path})")
+
+        vocabulary = cls(vocabulary_json["tokens"])
+        if vocabulary.version != vocabulary_json["version"]:
+            raise Exception(f"Vocabulary file ({vocabulary_path}) is corrupted")
+
+        return vocabulary
+
+    def save(self, vocabulary_path):
+        vocabulary_json = {
+            "format": VOCABULARY_FORMAT,
+            "version": self.version,
+            "tokens": self.idx_to_token[1:],
+        }
+
+        tmp_path = vocabulary_path.with_name(vocabulary_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(vocabulary_json, f)
+        os.replace(tmp_path, vocabulary_path)
+
+    def encode(self, tokens):
+        # Unknown tokens are -1
+        idx = self._token_index.get_indexer(tokens)
+        return np.where(idx == -1, -1, idx + 1).astype(np.int32)
+
+    def decode(self, idx):
+        return [self.idx_to_token[i] for i in idx]
+
+
+class EncodedPathsWriter:
+    def __init__(self, output_dir, vocabulary):
+        self._output_dir = output_dir
+        self._vocabulary = vocabulary
+        self._path_count = 0
+        self._token_count = 0
+
+        self._output_dir.mkdir(parents=True, exist_ok=True)
+
+        # New files renamed into place once complete, readers may still have
+        # the old ones memmapped and truncating them crashes the readers
+        self._tokens_path = self._output_dir / "tokens.bin"
+        self._offsets_path = self._output_dir / "offsets.bin"
+        self._tokens_file = open(_tmp_path(self._tokens_path), "wb")
+        self._offsets_file = open(_tmp_path(self._offsets_path), "wb")
+
+        # Offsets hold one more entry than paths, the first one is 0
+        self._offsets_file.write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A failed write never gets a meta.json
+        self.close(complete=exc_type is None)
+
+    def append(self, token_lists):
+        lengths = token_lists.str.len().to_numpy(dtype=np.int64)
+        row_ids = np.repeat(np.arange(len(token_lists)), lengths)
+        idx = self._vocabulary.encode(token_lists.explode().to_numpy(dtype=object))
+
+        # Tokens missing from the vocabulary are dropped, then empty paths
+        known = idx != -1
+        idx = idx[known]
+        lengths = np.bincount(row_ids[known], minlength=len(token_lists))
+        lengths = lengths[lengths > 0]
+
+        offsets = self._token_count + np.cumsum(lengths, dtype=np.int64)
+        self._tokens_file.write(idx.tobytes())
+        self._offsets_file.write(offsets.tobytes())
+
+        self._path_count += lengths.size
+        self._token_count += idx.size
+
+    def close(self, complete=True):
+        if self._tokens_file.closed:
+            return
+
+        self._tokens_file.close()
+        self._offsets_file.close()
+        if not complete:
+            # The previous encoded paths are left as they were
+            _tmp_path(self._tokens_path).unlink(missing_ok=True)
+            _tmp_path(self._offsets_path).unlink(missing_ok=True)
+            return
+
+        # meta.json is written last, without it the paths are incomplete
+        meta_path = self._output_dir / "meta.json"
+        meta_path.unlink(missing_ok=True)
+        os.replace(_tmp_path(self._tokens_path), self._tokens_path)
+        os.replace(_tmp_path(self._offsets_path), self._offsets_path)
+
+        meta = {
+            "vocabulary_version": self._vocabulary.version,
+            "paths": self._path_count,
+            "tokens": self._token_count,
+        }
+        with open(_tmp_path(meta_path), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(_tmp_path(meta_path), meta_path)
+
+
+class EncodedPaths:
+    def __init__(self, encoded_dir, vocabulary=None):
+        self.encoded_dir = encoded_dir
+
+        try:
+            with open(encoded_dir / "meta.json", "r", encoding="utf-8") as f:
+                self.meta = json.load(f)
+        except Exception as e:
+            raise Exception(f"Encoded paths ({encoded_dir}) are missing: {e}")
+
+        if (
+            vocabulary is not None
+            and vocabulary.version != self.meta["vocabulary_version"]
+        ):
+            raise Exception(
+                f"Encoded paths ({encoded_dir}) use another vocabulary version"
+            )
+
+        # Memory-mapped, pages are only read when a path is accessed
+        self.tokens = _memmap(encoded_dir / "tokens.bin", np.int32)
+        self.offsets = _memmap(encoded_dir / "offsets.bin", np.int64)
+
+    def __len__(self):
+        return self.meta["paths"]
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i] : self.offsets[i + 1]]
+
+
+def _tmp_path(path):
+    return path.with_name(path.name + ".tmp")
+
+
+def _memmap(path, dtype):
+    # np.memmap cannot map empty files
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode="r")
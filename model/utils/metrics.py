@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Prefix of every metric in the Prometheus textfile
+METRICS_NAMESPACE = "goneuro"
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+
+    # Backslashes, quotes and newlines are escaped in label values
+    pairs = []
+    for label, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        pairs.append(f'{label}="{value}"')
+
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metrics:
+    """Counters and timers shared by the collector, preprocessing and training.
+
+    Hooks only add to in-memory totals, they are always on and the totals
+    are only written out in profile mode.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self.started = time.time()
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            count, total, maximum = self._timers.get(key, (0, 0.0, 0.0))
+            self._timers[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._timers = {}
+            self.started = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timers = dict(self._timers)
+
+        report = {"counters": [], "timers": []}
+        for (name, labels), value in sorted(counters.items()):
+            report["counters"].append(
+                {"name": name, "labels": dict(labels), "value": value}
+            )
+
+        for (name, labels), (count, total, maximum) in sorted(timers.items()):
+            report["timers"].append(
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": count,
+                    "sum_seconds": total,
+                    "max_seconds": maximum,
+                    "mean_seconds": total / count,
+                }
+            )
+
+        return report
+
+    def write_json(self, report_path, **extra):
+        report = {
+            "started": self.started,
+            "finished": time.time(),
+            **extra,
+            **self.snapshot(),
+        }
+        _write_atomic(report_path, json.dumps(report, indent=4) + "\n")
+
+    def prometheus_text(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timers = dict(self._timers)
+
+        # Samples of a metric family must follow its TYPE line
+        families = {}
+        for (name, labels), value in sorted(counters.items()):
+            metric = f"{METRICS_NAMESPACE}_{name}_total"
+            families.setdefault((metric, "counter"), []).append(
+                f"{metric}{_prometheus_labels(labels)} {value}"
+            )
+
+        for (name, labels), (count, total, maximum) in sorted(timers.items()):
+            metric = f"{METRICS_NAMESPACE}_{name}_seconds"
+            labels_text = _prometheus_labels(labels)
+            families.setdefault((metric, "summary"), []).extend(
+                [
+                    f"{metric}_count{labels_text} {count}",
+                    f"{metric}_sum{labels_text} {total}",
+                ]
+            )
+            families.setdefault((f"{metric}_max", "gauge"), []).append(
+                f"{metric}_max{labels_text} {maximum}"
+            )
+
+        lines = []
+        for (metric, metric_type), samples in families.items():
+            lines.append(f"# TYPE {metric} {metric_type}")
+            lines.extend(samples)
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, textfile_path):
+        _write_atomic(textfile_path, self.prometheus_text())
+
+
+class MetricsExporter:
+    """Rewrite the Prometheus textfile every interval seconds.
+
+    Long running jobs can be scraped by the node exporter while they run,
+    the file is written one last time on stop().
+    """
+
+    def __init__(self, metrics, textfile_path, interval=15):
+        self._metrics = metrics
+        self._textfile_path = textfile_path
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            self._metrics.write_prometheus(self._textfile_path)
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        self._metrics.write_prometheus(self._textfile_path)
+
+
+def _write_atomic(path, text):
+    # The node exporter must never read a half written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# Process wide registry used by every hook
+metrics = Metrics()
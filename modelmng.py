@@ -1,22 +1,18 @@
-from model.training.collection import DataCollector
-from model.training.preprocess import PreprocessData
+from model.utils.metrics import MetricsExporter, metrics
 from model.training.setup import Setup
 
+# Stage modules (dask, TensorFlow) and the prompt layer are imported by the
+# methods that use them, batch commands only load what they run
 
 from utils.config_loader import Model
+from utils.dataset_registry import DatasetRegistry
 from utils.path_translate import pathtr
 
 from rich.console import Console
 from rich.theme import Theme
-from rich.markdown import Markdown
-from rich.table import Table
-from rich.rule import Rule
-from rich.pretty import Pretty
-from rich.progress import Progress
-
-from InquirerPy import inquirer
-from utils.validators import NumberValidator
 
+import argparse
+import atexit
 import os
 import sys
 from datetime import datetime
@@ -27,7 +23,7 @@ console = Console(theme=custom_theme)
 
 
 class Modelmgr:
-    def __init__(self):
+    def __init__(self, profile=False, interactive=True):
         self._is_env_setup = False
         self.script_name = os.path.splitext(os.path.basename(__file__))[0]
         self.inquirer_keybindings = {
@@ -35,10 +31,51 @@ class Modelmgr:
             "skip": [{"key": "left"}, {"key": "escape"}],
         }
         self.prompt = "> "
-        self._check_env_setup()
-        self._menu()
+        self._check_env_setup(interactive)
+        self._registry = self._open_registry()
+        if profile:
+            self._start_profile()
+
+    def _start_profile(self):
+        profile_config = model_config.json.get("profile", {})
+        report_path_abs = pathtr(profile_config.get("output_path", "profiles"))
+        textfile_path_abs = pathtr(
+            profile_config.get("textfile", "profiles/goneuro.prom")
+        )
+        run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+        # The textfile is refreshed while running, the report written on exit
+        exporter = MetricsExporter(
+            metrics, textfile_path_abs, profile_config.get("textfile_interval", 15)
+        ).start()
+
+        def write_report():
+            exporter.stop()
+            metrics.write_json(
+                report_path_abs / f"{run_id}.json", run_id=run_id, argv=sys.argv
+            )
+
+        atexit.register(write_report)
+        console.print(
+            f"[*] Profiling, report in ({report_path_abs / f'{run_id}.json'})",
+            style="info",
+        )
+
+    def _open_registry(self):
+        collection_config = model_config.json["collection"]
+        registry = DatasetRegistry(
+            pathtr(collection_config.get("registry_path", "config/registry.db"))
+        )
+
+        # Datasets used to be mapped in model.json, they are moved over once
+        dataset_dirs = collection_config.pop("dataset_dirs", None)
+        if dataset_dirs is not None:
+            registry.import_datasets(dataset_dirs)
+            model_config.save()
 
-    def _check_env_setup(self):
+        return registry
+
+    def _check_env_setup(self, interactive=True):
         # Translate paths from conf file to absolute
         data_struct_paths = list(model_config.json["data_struct_paths"].values())
         data_struct_abs_paths = [pathtr(path) for path in data_struct_paths]
@@ -48,6 +85,15 @@ class Modelmgr:
         # Check data dir structure
         missing_dir = setup.check_dir_struct()
         if setup.check_dir_struct() != False:
+            # Nobody to ask in batch mode, directories are just created
+            if not interactive:
+                setup.create_dir_struct()
+                console.print("[*] Created missing directories", style="info")
+                return
+
+            from InquirerPy import inquirer
+            from rich.markdown import Markdown
+
             console.print(
                 "[X] File structure missing or incomplete", style="danger", end=""
             )
@@ -72,6 +118,8 @@ class Modelmgr:
             console.print("[*] Created missing directories", style="info")
 
     def _menu(self):
+        from InquirerPy import inquirer
+
         menu_options = ["COLLECT", "PREPROCESS", "TRAIN", "INTERFACE", "QUIT"]
         try:
             while True:
@@ -91,28 +139,120 @@ class Modelmgr:
         except KeyboardInterrupt:
             sys.exit(1)
 
-    def collect(self):
-        options = ["ADD", "REMOVE", "INSPECT", "MANAGE", "RETURN"]
+    def _dataset_exists(self, dataset_name):
+        return self._registry.exists(dataset_name)
+
+    def _dataset_name_to_id(self, dataset_name):
+        return self._registry.name_to_id(dataset_name) or False
+
+    def _preprocess_data(self):
+        from model.training.preprocess import PreprocessData
+
+        raw_data_path_abs = pathtr(model_config.json["data_struct_paths"]["raw_data"])
+        preprocessed_data_path_abs = pathtr(
+            model_config.json["data_struct_paths"]["preprocessed_data"]
+        )
+        preprocess_config = model_config.json.get("preprocess", {})
+
+        return PreprocessData(
+            preprocessed_data_path_abs,
+            raw_data_path_abs / "datasets",
+            partition_size=preprocess_config.get("partition_size", "128MB"),
+            token_params=preprocess_config.get("token_params"),
+            min_domains=preprocess_config.get("min_domains", 10),
+        )
+
+    def _data_collector(self):
+        from model.training.collection import DataCollector
 
         data_dir_path_abs = pathtr(model_config.json["data_struct_paths"]["raw_data"])
-        data_collector = DataCollector(data_dir_path_abs)
+        collection_config = model_config.json["collection"]
+        return DataCollector(
+            data_dir_path_abs,
+            pool_size=collection_config.get("http_pool_size", 10),
+            max_retries=collection_config.get("http_max_retries", 3),
+            backoff_factor=collection_config.get("http_backoff_factor", 0.5),
+            metadata_ttl=collection_config.get("metadata_ttl", 7 * 24 * 60 * 60),
+            max_bytes_per_sec=collection_config.get("max_bytes_per_sec", 0),
+            projected_columns=collection_config.get("projected_columns"),
+        )
+
+    def _dataset_files(self, data_collector, dataset_dir):
+        base_url = "https://data.commoncrawl.org/"  # change to config file
+        dataset_list_file_stem = self._registry.get(dataset_dir)["data_list_stem"]
+        # Paths are streamed from the list file, only their ids are kept
+        data_list_ids = data_collector.list_file_to_id(
+            base_url,
+            data_collector.get_data_list(dataset_list_file_stem, lazy=True),
+        )
+        data_list_ids_downloaded = data_collector.downloaded_dataset_files(dataset_dir)
+        data_list_ids_missing = list(set(data_list_ids) - set(data_list_ids_downloaded))
+
+        return data_list_ids, data_list_ids_downloaded, data_list_ids_missing
+
+    def _download_missing(
+        self, data_collector, dataset_dir, data_list_ids, data_list_ids_missing, count
+    ):
+        from rich.progress import Progress
+
+        base_url = "https://data.commoncrawl.org/"  # change to config file
+        dataset_list_file_stem = self._registry.get(dataset_dir)["data_list_stem"]
+
+        full_time = datetime.now().strftime("%H:%M:%S")
+        file_word = "file" if count == 1 else "files"
+        console.print(f"[{full_time}] Downloading {count} new {file_word}")
+
+        # Pick the first missing files in data list order
+        data_list_ids_missing_set = set(data_list_ids_missing)
+        paths_to_download = []
+        data_list_paths = data_collector.get_data_list(
+            dataset_list_file_stem, lazy=True
+        )
+        for path, file_id in zip(data_list_paths, data_list_ids):
+            if len(paths_to_download) == count:
+                break
+            if file_id in data_list_ids_missing_set:
+                paths_to_download.append(path)
+                # Skip duplicated entries in the data list
+                data_list_ids_missing_set.discard(file_id)
+
+        # Upper bound only, the collector adapts to what the server accepts
+        collection_config = model_config.json["collection"]
+        max_workers = collection_config.get(
+            "max_concurrent_downloads", collection_config.get("http_pool_size", 10)
+        )
+        with Progress() as progress:
+            results = data_collector.download_dataset_batch(
+                base_url,
+                paths_to_download,
+                dataset_dir,
+                max_workers,
+                progress,
+            )
 
-        # Helper functions
-        def dataset_exists(dataset_name):
-            dataset_names = [
-                dataset["dataset_dir_name"]
-                for dataset in model_config.json["collection"]["dataset_dirs"].values()
-            ]
-            if dataset_name in dataset_names:
-                return True
+        for path, error in results["failed"].items():
+            console.print(f"[X] ({path}) {error}", style="danger")
 
-            return False
+        full_time = datetime.now().strftime("%H:%M:%S")
+        scheduler_stats = results["scheduler"]
+        console.print(
+            f"[{full_time}] Downloaded {len(results['downloaded'])}"
+            f" of {len(paths_to_download)} {file_word}"
+            f" ({scheduler_stats['concurrency']} parallel at the end)"
+        )
 
-        def dataset_name_to_id(dataset_name):
-            for id, dataset in model_config.json["collection"]["dataset_dirs"].items():
-                if dataset["dataset_dir_name"] == dataset_name:
-                    return id
-            return False
+        return results
+
+    def collect(self):
+        from InquirerPy import inquirer
+        from rich.pretty import Pretty
+        from rich.rule import Rule
+        from rich.table import Table
+        from utils.validators import NumberValidator
+
+        options = ["ADD", "REMOVE", "INSPECT", "MANAGE", "RETURN"]
+
+        data_collector = self._data_collector()
 
         # Menu functions
         def add_dataset():
@@ -121,6 +261,12 @@ class Modelmgr:
                 inquirer.text("Dataset name:", mandatory=True).execute().strip()
             )
 
+            if self._dataset_exists(dataset_name):
+                console.print(
+                    f"Dataset ({dataset_name}) already exists", style="warning"
+                )
+                return
+
             # Set data list to dataset
             data_list_url = (
                 inquirer.text("Data List Url:", mandatory=True).execute().strip()
@@ -160,22 +306,20 @@ class Modelmgr:
             # Create dataset
             dataset_dir_name = data_collector.create_dataset()
 
-            dataset_details = {
-                "dataset_dir_name": dataset_name,
-                "data_list_stem": data_list_stem,
-            }
-
-            # Map dir name in json file
-            model_config.json["collection"]["dataset_dirs"][
-                dataset_dir_name
-            ] = dataset_details
-            model_config.save()
+            # Map dir name in the registry
+            try:
+                self._registry.add(dataset_dir_name, dataset_name, data_list_stem)
+            except Exception as e:
+                # Another process took the name since the check above
+                data_collector.remove_dataset(dataset_dir_name)
+                console.print(str(e), style="warning")
 
         def remove_item():
             dataset_id = inquirer.text("Item id:", mandatory=True).execute().strip()
 
             # Check if datasets exists
-            if dataset_id not in model_config.json["collection"]["dataset_dirs"]:
+            dataset = self._registry.get(dataset_id)
+            if dataset is None:
                 data_list_id = dataset_id
                 if data_list_id not in data_collector.get_lists():
                     console.print(
@@ -185,29 +329,20 @@ class Modelmgr:
                     return
 
                 # Check if data list is not in used
-                for dataset in model_config.json["collection"]["dataset_dirs"].values():
-                    if dataset["data_list_stem"] == data_list_id:
-                        console.print(
-                            f"Data list ({data_list_id}) is being used by other datasets",
-                            style="warning",
-                        )
-                        return
+                if self._registry.list_users(data_list_id):
+                    console.print(
+                        f"Data list ({data_list_id}) is being used by other datasets",
+                        style="warning",
+                    )
+                    return
 
                 data_collector.remove_data_list(data_list_id)
                 return
 
             # Delete data list if not present in other datasets?
-            dataset_list_data_stem = model_config.json["collection"]["dataset_dirs"][
-                dataset_id
-            ]["data_list_stem"]
+            dataset_list_data_stem = dataset["data_list_stem"]
 
-            other_stems = {
-                v.get("data_list_stem")
-                for k, v in model_config.json["collection"]["dataset_dirs"].items()
-                if k != dataset_id
-            }
-
-            if dataset_list_data_stem not in other_stems:
+            if not self._registry.list_users(dataset_list_data_stem, dataset_id):
                 console.print(
                     "The data list associated with the dataset is not longer in use by other datasets",
                     style="info",
@@ -219,23 +354,22 @@ class Modelmgr:
                 if choice:
                     data_collector.remove_data_list(dataset_list_data_stem)
 
-            model_config.json["collection"]["dataset_dirs"].pop(dataset_id)
-            model_config.save()
+            self._registry.remove(dataset_id)
 
             data_collector.remove_dataset(dataset_id)
+            self._preprocess_data().delete(dataset_id)
 
         def inspect_dataset():
             console.print(Rule("Datasets"))
-            if model_config.json["collection"]["dataset_dirs"] == {}:
+            datasets = self._registry.datasets()
+            if datasets == {}:
                 console.print("There are no datasets")
             else:
                 datasets_table = Table()
                 datasets_table.add_column("name", justify="center")
                 datasets_table.add_column("id", justify="center")
 
-                for key, item in model_config.json["collection"][
-                    "dataset_dirs"
-                ].items():
+                for key, item in datasets.items():
                     datasets_table.add_row(item["dataset_dir_name"], key)
 
                 console.print(datasets_table)
@@ -249,16 +383,9 @@ class Modelmgr:
                 data_lists_table.add_column("id", justify="center")
                 data_lists_table.add_column("used in", justify="center")
 
+                list_usage = self._registry.list_usage()
                 for data_list_stem in data_lists:
-                    list_used_in = []
-                    for dataset in model_config.json["collection"][
-                        "dataset_dirs"
-                    ].values():
-                        if dataset["data_list_stem"] == data_list_stem:
-                            list_used_in.append(dataset["dataset_dir_name"])
-
-                    if not len(list_used_in):
-                        list_used_in = None
+                    list_used_in = list_usage.get(data_list_stem)
                     data_lists_table.add_row(data_list_stem, Pretty(list_used_in))
 
                 console.print(data_lists_table)
@@ -268,7 +395,7 @@ class Modelmgr:
                 inquirer.text("Dataset name:", mandatory=True).execute().strip()
             )
 
-            if not dataset_exists(dataset_name):
+            if not self._dataset_exists(dataset_name):
                 console.print(
                     f"Dataset ({dataset_name}) does not exist", style="warning"
                 )
@@ -289,23 +416,14 @@ class Modelmgr:
             if not manage_choice:
                 return
 
-            base_url = "https://data.commoncrawl.org/"  # change to config file
-            dataset_dir = dataset_name_to_id(dataset_name)
-            dataset_list_file_stem = model_config.json["collection"]["dataset_dirs"][
-                dataset_dir
-            ]["data_list_stem"]
-            data_list_paths = data_collector.get_data_list(dataset_list_file_stem)
-            data_list_ids = data_collector.list_file_to_id(base_url, data_list_paths)
-            data_list_ids_downloaded = data_collector.downloaded_dataset_files(
-                dataset_dir
-            )
-            data_list_ids_missing = list(
-                set(data_list_ids) - set(data_list_ids_downloaded)
+            dataset_dir = self._dataset_name_to_id(dataset_name)
+            data_list_ids, data_list_ids_downloaded, data_list_ids_missing = (
+                self._dataset_files(data_collector, dataset_dir)
             )
 
             files_table = Table(show_header=False)
             files_table.add_column()
-            files_table.add_row("Avalilable files", str(len(data_list_paths)))
+            files_table.add_row("Avalilable files", str(len(data_list_ids)))
             files_table.add_row("Downloaded files", str(len(data_list_ids_downloaded)))
             files_table.add_row("Missing files", str(len(data_list_ids_missing)))
             console.print(files_table)
@@ -320,35 +438,14 @@ class Modelmgr:
                         ).execute()
                     )
 
-                    full_time = datetime.now().strftime("%H:%M:%S")
-                    file_word = "file" if number_to_download == 1 else "files"
-                    console.print(
-                        f"[{full_time}] Downloading {number_to_download} new {file_word}"
+                    self._download_missing(
+                        data_collector,
+                        dataset_dir,
+                        data_list_ids,
+                        data_list_ids_missing,
+                        number_to_download,
                     )
 
-                    number_downloaded = number_to_download
-                    with Progress() as progress:
-                        overall_progress = progress.add_task(
-                            "Progress", total=number_to_download
-                        )
-                        for path in data_list_paths:
-                            if number_downloaded == 0:
-                                break
-
-                            url = base_url + path
-                            file_details = data_collector.check_url(url, base_url)
-                            file_id = file_details["list_file_stem"]
-                            file_size = file_details["size"]
-
-                            if file_id in data_list_ids_missing:
-                                # Download
-                                task_msg = f"Downloading {file_id} ({file_size} bytes)"
-                                data_collector.download_dataset(
-                                    base_url, path, dataset_dir, progress, task_msg
-                                )
-                                progress.update(overall_progress, advance=1)
-                                number_downloaded -= 1
-
                 case "delete":
                     number_to_delete = int(
                         inquirer.text(
@@ -388,18 +485,90 @@ class Modelmgr:
             if result == "return":
                 return
 
+    def _run_preprocess(self, preprocess_data, dataset_name):
+        from rich.progress import Progress
+
+        if not self._dataset_exists(dataset_name):
+            console.print(f"Dataset ({dataset_name}) does not exist", style="warning")
+            return False
+
+        dataset_dir = self._dataset_name_to_id(dataset_name)
+
+        full_time = datetime.now().strftime("%H:%M:%S")
+        console.print(f"[{full_time}] Preprocessing ({dataset_name})")
+
+        # An empty dataset is reported, not a crash of the menu
+        try:
+            with Progress() as progress:
+                result = preprocess_data.preprocess(dataset_dir, progress)
+        except Exception as e:
+            console.print(str(e), style="warning")
+            return False
+
+        full_time = datetime.now().strftime("%H:%M:%S")
+        console.print(
+            f"[{full_time}] {len(result['processed'])} new or changed files,"
+            f" {len(result['removed'])} removed"
+        )
+        return True
+
     def preprocess(self):
-        options = ["PREPROCESS", "LIST", "RETURN"]
+        from InquirerPy import inquirer
+        from rich.table import Table
+
+        options = ["PREPROCESS", "LIST", "DELETE", "RETURN"]
+
+        preprocess_data = self._preprocess_data()
 
         def preprocess():
-            pass
+            dataset_name = (
+                inquirer.text("Dataset name:", mandatory=True).execute().strip()
+            )
+            self._run_preprocess(preprocess_data, dataset_name)
 
         def list_preprocess_data():
-            pass
+            preprocessed = preprocess_data.list()
+            if not preprocessed:
+                console.print("There is no preprocessed data")
+                return
+
+            dataset_dirs = self._registry.datasets()
+
+            preprocessed_table = Table()
+            preprocessed_table.add_column("name", justify="center")
+            preprocessed_table.add_column("files", justify="center")
+            preprocessed_table.add_column("rows", justify="center")
+            preprocessed_table.add_column("vocabulary", justify="center")
+
+            for dataset_dir, details in preprocessed.items():
+                dataset_name = dataset_dirs.get(dataset_dir, {}).get(
+                    "dataset_dir_name", dataset_dir
+                )
+                preprocessed_table.add_row(
+                    dataset_name,
+                    str(details["files"]),
+                    str(details["rows"]),
+                    f"{details['vocabulary_size']} ({details['vocabulary_version']})",
+                )
+
+            console.print(preprocessed_table)
+
+        def delete_preprocess_data():
+            dataset_name = (
+                inquirer.text("Dataset name:", mandatory=True).execute().strip()
+            )
+
+            dataset_dir = self._dataset_name_to_id(dataset_name)
+            if not dataset_dir or not preprocess_data.delete(dataset_dir):
+                console.print(
+                    f"Dataset ({dataset_name}) has no preprocessed data",
+                    style="warning",
+                )
 
         actions = {
             "PREPROCESS": preprocess,
             "LIST": list_preprocess_data,
+            "DELETE": delete_preprocess_data,
             "RETURN": self.return_menu,
         }
 
@@ -422,8 +591,214 @@ class Modelmgr:
             if result == "return":
                 return
 
+    def _training_data(self, preprocess_data, dataset_name):
+        models_path_abs = pathtr(model_config.json["data_struct_paths"]["models"])
+
+        dataset_dir = self._dataset_name_to_id(dataset_name)
+        if not dataset_dir or dataset_dir not in preprocess_data.list():
+            console.print(
+                f"Dataset ({dataset_name}) has no preprocessed data",
+                style="warning",
+            )
+            return None, None
+
+        model_path = models_path_abs / dataset_dir
+        model_path.mkdir(parents=True, exist_ok=True)
+
+        return model_path, preprocess_data.load(dataset_dir)
+
+    def _train_params(self, model, mode=None):
+        # Defaults resolved, the same work always gets the same pipeline key
+        train_config = model_config.json.get("train", {})
+        match model:
+            case "lateral":
+                return {"neighbor_k": train_config.get("neighbor_k", 200)}
+            case "hierarchical":
+                return {
+                    "mode": mode or train_config.get("softmax", "full"),
+                    "epochs": train_config.get("epochs", 20),
+                    "batch_size": train_config.get("batch_size", 32),
+                    "num_sampled": train_config.get("num_sampled", 64),
+                    "eval_steps": train_config.get("eval_steps"),
+                }
+            case "trie":
+                return {"max_depth": train_config.get("trie_max_depth")}
+
+    def _train_lateral(self, model_path, preprocessed):
+        from model.training.train import LateralModel
+
+        params = self._train_params("lateral")
+        dataset, vocabulary, _ = preprocessed
+        full_time = datetime.now().strftime("%H:%M:%S")
+        console.print(f"[{full_time}] Training lateral model")
+
+        lateral_model = LateralModel.build(
+            dataset, vocabulary, neighbor_k=params["neighbor_k"]
+        )
+        lateral_model.save(model_path / "lateral.npz")
+
+        full_time = datetime.now().strftime("%H:%M:%S")
+        console.print(f"[{full_time}] Saved ({model_path / 'lateral.npz'})")
+
+    def _train_hierarchical(self, model_path, preprocessed, mode=None):
+        from model.training.train import train_hierarchical
+
+        train_config = model_config.json.get("train", {})
+        params = self._train_params("hierarchical", mode)
+        _, vocabulary, encoded_paths = preprocessed
+        mode = params["mode"]
+        full_time = datetime.now().strftime("%H:%M:%S")
+        console.print(f"[{full_time}] Training hierarchical model ({mode})")
+
+        def report_epoch(result):
+            console.print(
+                f"epoch {result['epoch']}: loss {result['loss']:.4f},"
+                f" {result['steps_per_sec']:.1f} steps/sec",
+                style="info",
+            )
+
+        try:
+            result = train_hierarchical(
+                encoded_paths,
+                vocabulary,
+                model_path / "hierarchical.keras",
+                mode=mode,
+                epochs=params["epochs"],
+                batch_size=params["batch_size"],
+                num_sampled=params["num_sampled"],
+                workers=train_config.get("batch_workers", 0),
+                eval_steps=params["eval_steps"],
+                callback=report_epoch,
+            )
+        except Exception as e:
+            console.print(str(e), style="warning")
+            return False
+
+        full_time = datetime.now().strftime("%H:%M:%S")
+        evaluation = result["evaluation"]
+        console.print(
+            f"[{full_time}] Full softmax loss {evaluation['loss']:.4f},"
+            f" {evaluation['steps_per_sec']:.1f} steps/sec"
+        )
+
+    def _train_trie(self, model_path, preprocessed):
+        from model.training.trie import PathTrie
+
+        params = self._train_params("trie")
+        _, vocabulary, encoded_paths = preprocessed
+        full_time = datetime.now().strftime("%H:%M:%S")
+        console.print(f"[{full_time}] Building path trie")
+
+        path_trie = PathTrie.build(
+            encoded_paths, vocabulary, max_depth=params["max_depth"]
+        )
+        path_trie.save(model_path / "trie")
+
+        full_time = datetime.now().strftime("%H:%M:%S")
+        console.print(
+            f"[{full_time}] Saved {len(path_trie)} nodes ({model_path / 'trie'})"
+        )
+
     def train(self):
-        pass
+        from InquirerPy import inquirer
+
+        options = ["LATERAL", "HIERARCHICAL", "TRIE", "RETURN"]
+
+        preprocess_data = self._preprocess_data()
+
+        def train_model(train_function):
+            def train_selected():
+                dataset_name = (
+                    inquirer.text("Dataset name:", mandatory=True).execute().strip()
+                )
+
+                model_path, preprocessed = self._training_data(
+                    preprocess_data, dataset_name
+                )
+                if preprocessed is not None:
+                    train_function(model_path, preprocessed)
+
+            return train_selected
+
+        actions = {
+            "LATERAL": train_model(self._train_lateral),
+            "HIERARCHICAL": train_model(self._train_hierarchical),
+            "TRIE": train_model(self._train_trie),
+            "RETURN": self.return_menu,
+        }
+
+        while True:
+            action = inquirer.select(
+                message=self.prompt,
+                choices=options,
+                keybindings=self.inquirer_keybindings,
+                mandatory=False,
+            ).execute()
+
+            # Return to main menu if skipped
+            if action == None:
+                return
+
+            # Call corresponding function in the dictionary
+            result = actions[action]()
+
+            # Return or continue according to the return value of the function
+            if result == "return":
+                return
+
+    def interface(self):
+        from InquirerPy import inquirer
+        from model.interface import InferenceService, create_server
+        from model.training.vocabulary import Vocabulary
+
+        preprocessed_data_path_abs = pathtr(
+            model_config.json["data_struct_paths"]["preprocessed_data"]
+        )
+        models_path_abs = pathtr(model_config.json["data_struct_paths"]["models"])
+        interface_config = model_config.json.get("interface", {})
+
+        dataset_name = inquirer.text("Dataset name:", mandatory=True).execute().strip()
+
+        dataset_dir = self._dataset_name_to_id(dataset_name)
+        if not dataset_dir or not (models_path_abs / dataset_dir).exists():
+            console.print(
+                f"Dataset ({dataset_name}) has no trained models", style="warning"
+            )
+            return
+
+        vocabulary = Vocabulary.load(
+            preprocessed_data_path_abs / dataset_dir / "vocab.json"
+        )
+        service = InferenceService(
+            models_path_abs / dataset_dir,
+            vocabulary,
+            max_batch_size=interface_config.get("max_batch_size", 256),
+            max_wait_ms=interface_config.get("max_wait_ms", 2),
+        )
+
+        unix_socket = interface_config.get("unix_socket")
+        server = create_server(
+            service,
+            host=interface_config.get("host", "127.0.0.1"),
+            port=interface_config.get("port", 8765),
+            unix_socket=pathtr(unix_socket) if unix_socket else None,
+        )
+
+        address = unix_socket or f"{server.server_name}:{server.server_port}"
+        full_time = datetime.now().strftime("%H:%M:%S")
+        console.print(
+            f"[{full_time}] Serving {', '.join(service.models)} on ({address}),"
+            " Ctrl+C to stop"
+        )
+
+        # Ctrl+C stops the server and returns to the menu
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            service.close()
 
     def return_menu(self):
         return "return"
@@ -432,4 +807,249 @@ class Modelmgr:
         sys.exit(0)
 
 
-modelmgr = Modelmgr()
+def batch_collect(modelmgr, args):
+    dataset_dir = modelmgr._dataset_name_to_id(args.dataset)
+    if not dataset_dir:
+        console.print(f"Dataset ({args.dataset}) does not exist", style="warning")
+        return 1
+
+    data_collector = modelmgr._data_collector()
+    data_list_ids, _, data_list_ids_missing = modelmgr._dataset_files(
+        data_collector, dataset_dir
+    )
+
+    count = min(args.count, len(data_list_ids_missing))
+    if not count:
+        console.print(f"Dataset ({args.dataset}) has no missing files")
+        return 0
+
+    results = modelmgr._download_missing(
+        data_collector, dataset_dir, data_list_ids, data_list_ids_missing, count
+    )
+    return 1 if results["failed"] else 0
+
+
+def batch_preprocess(modelmgr, args):
+    # Checked before dask is imported by _preprocess_data
+    if not modelmgr._dataset_exists(args.dataset):
+        console.print(f"Dataset ({args.dataset}) does not exist", style="warning")
+        return 1
+
+    if not modelmgr._run_preprocess(modelmgr._preprocess_data(), args.dataset):
+        return 1
+
+    return 0
+
+
+def batch_train(modelmgr, args):
+    model_path, preprocessed = modelmgr._training_data(
+        modelmgr._preprocess_data(), args.dataset
+    )
+    if preprocessed is None:
+        return 1
+
+    match args.model:
+        case "lateral":
+            modelmgr._train_lateral(model_path, preprocessed)
+        case "hierarchical":
+            if (
+                modelmgr._train_hierarchical(model_path, preprocessed, args.softmax)
+                is False
+            ):
+                return 1
+        case "trie":
+            modelmgr._train_trie(model_path, preprocessed)
+
+    return 0
+
+
+def batch_pipeline(modelmgr, args):
+    from model.pipeline import Pipeline, directory_signature, file_signature
+    from model.training.formats import (
+        DEFAULT_TOKEN_PARAMS,
+        PREPROCESS_FORMAT,
+        TRIE_FORMAT,
+        VOCABULARY_FORMAT,
+    )
+
+    dataset_dir = modelmgr._dataset_name_to_id(args.dataset)
+    if not dataset_dir:
+        console.print(f"Dataset ({args.dataset}) does not exist", style="warning")
+        return 1
+
+    data_struct_paths = model_config.json["data_struct_paths"]
+    dataset_path_abs = pathtr(data_struct_paths["raw_data"]) / "datasets" / dataset_dir
+    preprocessed_path_abs = pathtr(data_struct_paths["preprocessed_data"]) / dataset_dir
+    model_path_abs = pathtr(data_struct_paths["models"]) / dataset_dir
+    pipeline = Pipeline(model_path_abs / "pipeline.json")
+    exit_code = 0
+
+    # Downloads depend on the remote list, they are never skipped
+    if args.count:
+        if batch_collect(modelmgr, args):
+            exit_code = 1
+
+    # Lazy, only stages that run pay for dask and the preprocessed data
+    preprocess_data = None
+
+    def get_preprocess_data():
+        nonlocal preprocess_data
+        if preprocess_data is None:
+            preprocess_data = modelmgr._preprocess_data()
+        return preprocess_data
+
+    preprocess_config = model_config.json.get("preprocess", {})
+    results = []
+
+    # Every model depends on the preprocessed data through its manifest
+    preprocessed = None
+
+    def train(train_function, **kwargs):
+        def run():
+            nonlocal preprocessed
+            if preprocessed is None:
+                _, preprocessed = modelmgr._training_data(
+                    get_preprocess_data(), args.dataset
+                )
+                if preprocessed is None:
+                    return False
+            return train_function(model_path_abs, preprocessed, **kwargs)
+
+        return run
+
+    model_stages = {
+        "lateral": (modelmgr._train_lateral, "lateral.npz", {}, None),
+        "hierarchical": (
+            modelmgr._train_hierarchical,
+            "hierarchical.keras",
+            {"mode": args.softmax},
+            None,
+        ),
+        "trie": (modelmgr._train_trie, "trie", {}, TRIE_FORMAT),
+    }
+
+    # Later stages use the output of earlier ones, the first failure stops
+    try:
+        results.append(
+            pipeline.run_stage(
+                "preprocess",
+                {
+                    "files": directory_signature(dataset_path_abs, "*.parquet"),
+                    "token_params": {
+                        **DEFAULT_TOKEN_PARAMS,
+                        **(preprocess_config.get("token_params") or {}),
+                    },
+                    "min_domains": preprocess_config.get("min_domains", 10),
+                    "formats": [PREPROCESS_FORMAT, VOCABULARY_FORMAT],
+                },
+                lambda: modelmgr._run_preprocess(get_preprocess_data(), args.dataset),
+                [preprocessed_path_abs / "manifest.json"],
+                args.force,
+            )
+        )
+
+        manifest_signature = file_signature(preprocessed_path_abs / "manifest.json")
+        for model in args.models:
+            train_function, output_name, kwargs, output_format = model_stages[model]
+            results.append(
+                pipeline.run_stage(
+                    f"train_{model}",
+                    {
+                        "model": model,
+                        "preprocessed": manifest_signature,
+                        "train": modelmgr._train_params(model, args.softmax),
+                        "format": output_format,
+                    },
+                    train(train_function, **kwargs),
+                    [model_path_abs / output_name],
+                    args.force,
+                    cache=True,
+                )
+            )
+    except Exception as e:
+        console.print(str(e), style="danger")
+        exit_code = 1
+
+    for result in results:
+        state = "ran" if result["ran"] else "up to date, skipped"
+        if result["restored"]:
+            state = "restored from cache"
+        console.print(f"[*] {result['stage']} ({result['key']}) {state}", style="info")
+
+    return exit_code
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Model manager, interactive without a command"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write a JSON report and a Prometheus textfile with stage metrics",
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    collect_parser = commands.add_parser("collect", help="collect data")
+    collect_commands = collect_parser.add_subparsers(dest="collect_command")
+    collect_commands.required = True
+    download_parser = collect_commands.add_parser(
+        "download", help="download missing files of a dataset"
+    )
+    download_parser.add_argument("--dataset", required=True, help="dataset name")
+    download_parser.add_argument(
+        "--count", type=int, required=True, help="number of files to download"
+    )
+    download_parser.set_defaults(handler=batch_collect)
+
+    preprocess_parser = commands.add_parser("preprocess", help="preprocess a dataset")
+    preprocess_parser.add_argument("--dataset", required=True, help="dataset name")
+    preprocess_parser.set_defaults(handler=batch_preprocess)
+
+    train_parser = commands.add_parser("train", help="train a model")
+    train_parser.add_argument("--dataset", required=True, help="dataset name")
+    train_parser.add_argument(
+        "--model", choices=["lateral", "hierarchical", "trie"], required=True
+    )
+    train_parser.add_argument(
+        "--softmax", choices=["full", "sampled"], help="hierarchical training mode"
+    )
+    train_parser.set_defaults(handler=batch_train)
+
+    pipeline_parser = commands.add_parser(
+        "pipeline", help="run collect, preprocess and train, skipping unchanged stages"
+    )
+    pipeline_parser.add_argument("--dataset", required=True, help="dataset name")
+    pipeline_parser.add_argument(
+        "--count", type=int, default=0, help="number of new files to download first"
+    )
+    pipeline_parser.add_argument(
+        "--models",
+        nargs="+",
+        choices=["lateral", "hierarchical", "trie"],
+        default=["lateral", "trie"],
+    )
+    pipeline_parser.add_argument(
+        "--softmax", choices=["full", "sampled"], help="hierarchical training mode"
+    )
+    pipeline_parser.add_argument(
+        "--force", action="store_true", help="run every stage even if up to date"
+    )
+    pipeline_parser.set_defaults(handler=batch_pipeline)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    modelmgr = Modelmgr(profile=args.profile, interactive=args.command is None)
+    if args.command is None:
+        modelmgr._menu()
+        return
+
+    sys.exit(args.handler(modelmgr, args))
+
+
+if __name__ == "__main__":
+    main()
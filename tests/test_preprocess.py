@@ -0,0 +1,140 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from model.training.preprocess import tokenize_url_paths
+
+
+# Notebook pipeline, cells "Tokenization" and "Local Token Filtering"
+def validate_path(url):
+    return url if isinstance(url, str) and "/" in url else None
+
+
+def clean_slashes(url):
+    url = url.strip().strip("/")
+
+    return url if url else None
+
+
+def url_tokenize_pipeline(url):
+    url = validate_path(url)
+    if not url:
+        return None
+
+    url = clean_slashes(url)
+    if not url:
+        return None
+
+    return url.split("/")
+
+
+def is_allowed_char(c):
+    return c.isalnum() or c in "-_%"
+
+
+def is_mostly_digits(s, threshold=0.5):
+    digit_count = sum(c.isdigit() for c in s)
+    return (digit_count / len(s)) >= threshold
+
+
+def token_filter_pipeline(tokens):
+    # Empty tokens ("a//b") divide by zero in is_mostly_digits, preprocess
+    # drops them
+    tokens = [d for d in tokens if d]
+    tokens = [d for d in tokens if all(is_allowed_char(c) for c in d)]
+    tokens = [d for d in tokens if len(d) <= 15]
+    tokens = [
+        d
+        for d in tokens
+        if not (d.isdigit() and len(d) > 6)
+        and not (is_mostly_digits(d) and len(d) > 10)
+    ]
+
+    return tokens if tokens else None
+
+
+def notebook_tokenize(url_paths):
+    positions, token_lists = [], []
+    for i, url in enumerate(url_paths):
+        # str.lower(), the "str" dtype would lower with Arrow
+        url = url.lower() if isinstance(url, str) else url
+        tokens = url_tokenize_pipeline(url)
+        if tokens is not None:
+            tokens = token_filter_pipeline(tokens)
+        if tokens is not None:
+            positions.append(i)
+            token_lists.append(tokens)
+
+    return positions, token_lists
+
+
+# Characters where str and Arrow semantics are easy to get wrong
+EDGE_CHARS = [
+    "İ",  # lower() gives two characters
+    "Σ",  # final sigma depends on the next character
+    "ẞ",
+    "²",  # isdigit() but not isdecimal()
+    "٣",
+    "Ⅻ",  # isalnum() through isnumeric()
+    "é",
+    "日",
+    "\x1c",  # str.strip() whitespace, not C isspace()
+    "\x85",
+    "\xa0",
+    "　",
+    "\t",
+    " ",
+    "%",
+    "-",
+    "_",
+    ".",
+    "?",
+    "=",
+]
+
+
+def random_paths(count, seed):
+    rng = random.Random(seed)
+    alphabet = "abcXYZ0123456789/" + "".join(EDGE_CHARS)
+    words = ["admin", "API", "wp-content", "2024", "1234567", "v2", "a1b2c3d4e5f6"]
+
+    paths = []
+    for _ in range(count):
+        match rng.randrange(4):
+            case 0:
+                depth = rng.randrange(6)
+                path = "/" + "/".join(rng.choice(words) for _ in range(depth))
+            case 1:
+                path = "".join(rng.choice(alphabet) for _ in range(rng.randrange(30)))
+            case 2:
+                path = "/" + "/".join(
+                    "".join(rng.choice(alphabet) for _ in range(rng.randrange(14)))
+                    for _ in range(rng.randrange(8))
+                )
+            case 3:
+                path = rng.choice(["", "/", "//", " / ", "\x85/\x85", None, "no-slash"])
+        paths.append(path)
+
+    return paths
+
+
+@pytest.mark.parametrize("dtype", [object, "str"])
+def test_tokenize_url_paths_matches_notebook(dtype):
+    url_paths = pd.Series(random_paths(20000, seed=1), dtype=dtype)
+
+    positions, token_lists = tokenize_url_paths(url_paths)
+    expected_positions, expected_token_lists = notebook_tokenize(url_paths)
+
+    assert positions.tolist() == expected_positions
+    assert token_lists.to_pylist() == expected_token_lists
+
+
+def test_tokenize_url_paths_max_depth():
+    url_paths = pd.Series(["/a/b/c/d", "/1234567/a/b", "/x"], dtype=object)
+
+    positions, token_lists = tokenize_url_paths(url_paths, max_depth=2)
+
+    assert np.array_equal(positions, [0, 1, 2])
+    assert token_lists.to_pylist() == [["a", "b"], ["a", "b"], ["x"]]
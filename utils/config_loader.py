@@ -1,4 +1,5 @@
 import json
+import os
 from utils.path_translate import pathtr
 
 
@@ -16,7 +17,8 @@ class Model:
         self.json = _load_config(self._config_path)
 
     def save(self):
-        with open(self._config_path, "w") as f:
+        # Replaced in one step, other processes never read half a file
+        tmp_path = self._config_path.with_name(self._config_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(self.json, f, indent=4, sort_keys=True)
-
-        self.json = _load_config(self._config_path)
+        os.replace(tmp_path, self._config_path)
@@ -0,0 +1,149 @@
+import sqlite3
+from contextlib import contextmanager
+
+REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    data_list_stem TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS datasets_data_list_stem ON datasets (data_list_stem);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class DatasetRegistry:
+    """Datasets and the data lists they use, kept in SQLite.
+
+    Lookups by name and by data list go through indexes and a change only
+    writes the rows it touches. In WAL mode readers never wait for a writer,
+    writers of other processes wait up to timeout seconds for each other.
+    """
+
+    def __init__(self, registry_path, timeout=30):
+        registry_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Autocommit, transactions are opened explicitly by transaction()
+        self._conn = sqlite3.connect(
+            registry_path, timeout=timeout, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(REGISTRY_SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        # Nested calls join the outer transaction, one commit for the batch
+        if self._conn.in_transaction:
+            yield
+            return
+
+        # Write lock taken up front, no deadlock upgrading a read lock
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def add(self, dataset_id, name, data_list_stem):
+        try:
+            with self.transaction():
+                self._conn.execute(
+                    "INSERT INTO datasets (id, name, data_list_stem) VALUES (?, ?, ?)",
+                    (dataset_id, name, data_list_stem),
+                )
+        except sqlite3.IntegrityError:
+            raise Exception(f"Dataset ({name}) or id ({dataset_id}) already exists")
+
+    def remove(self, dataset_id):
+        with self.transaction():
+            cursor = self._conn.execute(
+                "DELETE FROM datasets WHERE id = ?", (dataset_id,)
+            )
+
+        return cursor.rowcount > 0
+
+    def import_datasets(self, dataset_dirs):
+        """Move datasets from the old model.json mapping, only done once."""
+        with self.transaction():
+            imported = self._conn.execute(
+                "SELECT 1 FROM meta WHERE key = 'imported_config'"
+            ).fetchone()
+            if imported:
+                return 0
+
+            count = 0
+            for dataset_id, dataset in dataset_dirs.items():
+                name = dataset["dataset_dir_name"]
+                # Names were not unique before, later duplicates get their id
+                if self.name_to_id(name) is not None:
+                    name = f"{name} ({dataset_id})"
+
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO datasets (id, name, data_list_stem)"
+                    " VALUES (?, ?, ?)",
+                    (dataset_id, name, dataset["data_list_stem"]),
+                )
+                count += cursor.rowcount
+
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('imported_config', ?)",
+                (str(count),),
+            )
+
+        return count
+
+    def get(self, dataset_id):
+        row = self._conn.execute(
+            "SELECT name, data_list_stem FROM datasets WHERE id = ?", (dataset_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        return {"dataset_dir_name": row[0], "data_list_stem": row[1]}
+
+    def name_to_id(self, name):
+        row = self._conn.execute(
+            "SELECT id FROM datasets WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def exists(self, name):
+        return self.name_to_id(name) is not None
+
+    def datasets(self):
+        # Same shape as the old dataset_dirs mapping, in creation order
+        rows = self._conn.execute(
+            "SELECT id, name, data_list_stem FROM datasets ORDER BY rowid"
+        )
+        return {
+            dataset_id: {"dataset_dir_name": name, "data_list_stem": data_list_stem}
+            for dataset_id, name, data_list_stem in rows
+        }
+
+    def list_users(self, data_list_stem, exclude=None):
+        rows = self._conn.execute(
+            "SELECT name FROM datasets WHERE data_list_stem = ? AND id IS NOT ?"
+            " ORDER BY rowid",
+            (data_list_stem, exclude),
+        )
+        return [name for (name,) in rows]
+
+    def list_usage(self):
+        # data list stem -> names of the datasets using it
+        usage = {}
+        rows = self._conn.execute(
+            "SELECT data_list_stem, name FROM datasets ORDER BY rowid"
+        )
+        for data_list_stem, name in rows:
+            usage.setdefault(data_list_stem, []).append(name)
+
+        return usage
+
+    def close(self):
+        self._conn.close()